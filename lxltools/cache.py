@@ -0,0 +1,410 @@
+# -*- coding: UTF-8 -*-
+from __future__ import unicode_literals, print_function
+__metaclass__ = type
+
+from collections import OrderedDict, namedtuple
+from threading import RLock, Thread
+import json
+import logging
+import os
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    """
+    A bounded, thread-safe mapping evicting the least recently used entry,
+    and optionally entries older than ttl seconds. If given, on_evict is
+    called with the key and value of each entry evicted to make room.
+
+    >>> cache = LRUCache(maxsize=2)
+    >>> cache.set('a', 1); cache.set('b', 2)
+    >>> cache.get('a')
+    1
+    >>> cache.set('c', 3)
+    >>> 'b' in cache, 'a' in cache, 'c' in cache
+    (False, True, True)
+    >>> cache.get('b')
+    >>> cache.hits, cache.misses
+    (1, 1)
+
+    >>> expiring = LRUCache(ttl=-1)
+    >>> expiring.set('a', 1)
+    >>> 'a' in expiring, expiring.get('a')
+    (False, None)
+    """
+
+    def __init__(self, maxsize=10000, ttl=None, on_evict=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = RLock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires < time.time():
+                self.misses += 1
+                return default
+            self._data[key] = expires, value
+            self.hits += 1
+            return value
+
+    def peek(self, key, default=None):
+        """
+        Get a value without counting or refreshing it.
+        """
+        expires, value = self._data.get(key, (None, default))
+        if expires is not None and expires < time.time():
+            return default
+        return value
+
+    def set(self, key, value):
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = expires, value
+            while len(self._data) > self.maxsize:
+                evicted_key, (expires, evicted) = self._data.popitem(last=False)
+                if self.on_evict:
+                    self.on_evict(evicted_key, evicted)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            expires, value = self._data.pop(key, (None, default))
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        expires, value = self._data.get(key, (None, _MISSING))
+        return value is not _MISSING and (expires is None or expires >= time.time())
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return _stats(len(self), self.hits, self.misses)
+
+
+_MISSING = object()
+
+
+ChipEntry = namedtuple('ChipEntry', 'modified, chip, label')
+
+
+class ChipCache:
+    """
+    Labelled chips keyed by entity id, held in a local LRU and optionally in
+    a shared backend (any client with ``get(key)``, ``set(key, value)`` and
+    ``delete(key)``, such as a memcached or redis client).
+
+    Entries carry the modification time of the record they were made from. A
+    newer modification time replaces (or, on get, invalidates) an entry.
+
+    Chips are kept serialized, so that every get returns a fresh copy.
+
+    >>> chips = ChipCache(maxsize=10)
+    >>> chips.put('/a', {'@id': '/a'}, 'A', '2016-01-01T00:00:00')
+    >>> print(chips.get('/a').label)
+    A
+    >>> chips.get('/a').chip['@id'] = '/changed'
+    >>> print(chips.get('/a').chip['@id'])
+    /a
+    >>> chips.put('/a', {'@id': '/a'}, 'Old', '2015-01-01T00:00:00')
+    >>> print(chips.get('/a').label)
+    A
+    >>> chips.get('/a', modified='2017-01-01T00:00:00')
+    >>> chips.get('/a')
+    >>> chips.hits, chips.misses
+    (4, 2)
+    """
+
+    def __init__(self, maxsize=10000, backend=None, key_prefix='chip:'):
+        self.local = LRUCache(maxsize)
+        self.backend = backend
+        self.key_prefix = key_prefix
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    def get(self, item_id, modified=None):
+        entry = self._get_entry(item_id, modified)
+        if entry is not None:
+            return entry._replace(chip=json.loads(entry.chip))
+
+    def get_label(self, item_id, modified=None):
+        """
+        Get just the label of a cached chip.
+        """
+        entry = self._get_entry(item_id, modified)
+        if entry is not None:
+            return entry.label
+
+    def _get_entry(self, item_id, modified=None):
+        entry = self.local.get(item_id)
+        if entry is None and self.backend is not None:
+            entry = self._get_shared(item_id)
+            if entry is not None:
+                self.local.set(item_id, entry)
+        if entry is not None and _is_older(entry.modified, modified):
+            self.stale += 1
+            self.invalidate(item_id)
+            entry = None
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def put(self, item_id, chip, label, modified=None):
+        current = self.local.peek(item_id)
+        if current is not None and _is_older(modified, current.modified):
+            return
+        self.local.set(item_id, ChipEntry(modified, json.dumps(chip), label))
+        if self.backend is not None:
+            self._set_shared(item_id, ChipEntry(modified, chip, label))
+
+    def invalidate(self, item_id):
+        self.local.pop(item_id)
+        if self.backend is not None:
+            try:
+                self.backend.delete(self.key_prefix + item_id)
+            except Exception as e:
+                logger.warning("Failed to invalidate shared chip <%s>: %s", item_id, e)
+
+    def stats(self):
+        stats = _stats(len(self.local), self.hits, self.misses)
+        stats['stale'] = self.stale
+        return stats
+
+    def _get_shared(self, item_id):
+        try:
+            raw = self.backend.get(self.key_prefix + item_id)
+        except Exception as e:
+            logger.warning("Failed to get shared chip <%s>: %s", item_id, e)
+            return None
+        if raw:
+            modified, chip, label = json.loads(raw)
+            return ChipEntry(modified, json.dumps(chip), label)
+
+    def _set_shared(self, item_id, entry):
+        try:
+            self.backend.set(self.key_prefix + item_id, json.dumps(entry))
+        except Exception as e:
+            logger.warning("Failed to set shared chip <%s>: %s", item_id, e)
+
+
+class DecoratedCache:
+    """
+    Decorated views of records, keyed by record id and view variant, and
+    valid for as long as the record modification time is unchanged. Views
+    can depend on other ids (e.g. of records referencing the record), and
+    are dropped when any of those is invalidated.
+
+    Views are kept serialized, so that every get returns a fresh copy.
+
+    >>> views = DecoratedCache()
+    >>> views.put('/r', 'full', '2016', {'@id': '/r'}, depends_on=['/q'])
+    >>> views.get('/r', 'full', '2016') == {'@id': '/r'}
+    True
+    >>> views.get('/r', 'full', '2017')
+    >>> views.put('/r', 'full', '2016', {'@id': '/r'}, depends_on=['/q'])
+    >>> views.invalidate('/q')
+    >>> views.get('/r', 'full', '2016')
+
+    Dependencies are forgotten along with evicted views:
+
+    >>> views = DecoratedCache(maxsize=1)
+    >>> views.put('/r', 'full', '2016', {'@id': '/r'}, depends_on=['/q'])
+    >>> views.put('/s', 'full', '2016', {'@id': '/s'}, depends_on=['/t'])
+    >>> list(views.dependents) == ['/t']
+    True
+    """
+
+    def __init__(self, maxsize=1000):
+        self.local = LRUCache(maxsize, on_evict=self._forget)
+        self.dependents = {}
+        self._lock = RLock()
+
+    def get(self, record_id, variant, modified):
+        entry = self.local.get(record_id)
+        if entry is None or entry['modified'] != modified:
+            return None
+        view = entry['views'].get(variant)
+        return json.loads(view) if view is not None else None
+
+    def put(self, record_id, variant, modified, view, depends_on=()):
+        with self._lock:
+            entry = self.local.peek(record_id)
+            if entry is None or entry['modified'] != modified:
+                if entry is not None:
+                    self._forget(record_id, entry)
+                entry = {'modified': modified, 'views': {}, 'depends_on': set()}
+                self.local.set(record_id, entry)
+            entry['views'][variant] = json.dumps(view)
+            for dep_id in depends_on:
+                self.dependents.setdefault(dep_id, set()).add(record_id)
+                entry['depends_on'].add(dep_id)
+
+    def invalidate(self, *ids):
+        """
+        Drop cached views of the given record ids, and of records depending
+        on any of the given ids.
+        """
+        with self._lock:
+            for some_id in ids:
+                self._drop(some_id)
+                for record_id in self.dependents.pop(some_id, ()):
+                    self._drop(record_id)
+
+    def stats(self):
+        return self.local.stats()
+
+    def _drop(self, record_id):
+        entry = self.local.pop(record_id)
+        if entry is not None:
+            self._forget(record_id, entry)
+
+    def _forget(self, record_id, entry):
+        """
+        Remove the dependencies of a view which is no longer cached.
+        """
+        with self._lock:
+            for dep_id in entry['depends_on']:
+                record_ids = self.dependents.get(dep_id)
+                if record_ids is not None:
+                    record_ids.discard(record_id)
+                    if not record_ids:
+                        del self.dependents[dep_id]
+
+
+class StatsCache:
+    """
+    Computed statistics by key, rebuilt in the background when older than
+    ``ttl`` seconds. If ``get_generation`` is given, a stale entry is only
+    rebuilt if the generation it reports (e.g. an index change counter) has
+    changed. Entries are persisted as JSON to ``path`` if given, so that a
+    restarted process can serve them immediately. ``on_thread_exit`` is
+    called at the end of each background thread, e.g. to release resources
+    (such as a database connection) opened by a rebuild.
+
+    >>> stats = StatsCache(ttl=60)
+    >>> stats.get('key', lambda: 1)
+    1
+    >>> stats.get('key', lambda: 2)
+    1
+    """
+
+    def __init__(self, ttl=60, get_generation=None, path=None, on_thread_exit=None):
+        self.ttl = ttl
+        self.get_generation = get_generation
+        self.path = path
+        self.on_thread_exit = on_thread_exit
+        self._entries = self._load() if path else {}
+        self._refreshing = set()
+        self._lock = RLock()
+
+    def get(self, key, build):
+        entry = self._entries.get(key)
+        if entry is None:
+            return self._rebuild(key, build)
+        if time.time() - entry['checked'] > self.ttl:
+            self.refresh(key, build)
+        return entry['value']
+
+    def refresh(self, key, build):
+        """
+        Check and, if needed, rebuild the entry for key in a background thread.
+        """
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+        thread = Thread(target=self._refresh, args=(key, build))
+        thread.daemon = True
+        thread.start()
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def _refresh(self, key, build):
+        try:
+            entry = self._entries.get(key)
+            if entry and entry['generation'] is not None:
+                if self._get_generation() == entry['generation']:
+                    entry['checked'] = time.time()
+                    return
+            self._rebuild(key, build)
+        except Exception as e:
+            logger.exception("Failed to refresh statistics for %s: %s", key, e)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+            if self.on_thread_exit:
+                self.on_thread_exit()
+
+    def _rebuild(self, key, build):
+        generation = self._get_generation()
+        value = build()
+        now = time.time()
+        with self._lock:
+            self._entries[key] = {'value': value, 'generation': generation,
+                                  'built': now, 'checked': now}
+            if self.path:
+                self._save()
+        return value
+
+    def _get_generation(self):
+        if self.get_generation is None:
+            return None
+        try:
+            return self.get_generation()
+        except Exception as e:
+            logger.warning("Failed to get generation: %s", e)
+            return None
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path) as fp:
+                return json.load(fp)
+        except ValueError as e:
+            logger.warning("Ignoring unreadable statistics cache %s: %s", self.path, e)
+            return {}
+
+    def _save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as fp:
+            json.dump(self._entries, fp)
+        os.rename(tmp_path, self.path)
+
+
+def _is_older(modified, other):
+    return bool(modified and other and modified < other)
+
+
+def _stats(size, hits, misses):
+    total = hits + misses
+    return {
+        'size': size,
+        'hits': hits,
+        'misses': misses,
+        'hitRatio': float(hits) / total if total else None
+    }
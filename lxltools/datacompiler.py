@@ -5,26 +5,42 @@ if bytes is not str:
 
 import argparse
 from collections import OrderedDict
+from contextlib import closing
 try:
     from pathlib import Path
 except ImportError:
     from pathlib2 import Path
 try:
     from urllib.parse import urlparse, urljoin, quote
-    from urllib.request import urlopen
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError
 except ImportError:
     from urlparse import urlparse, urljoin
-    from urllib2 import quote, urlopen
+    from urllib2 import quote, urlopen, Request, HTTPError
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+import gzip
+import hashlib
+import inspect
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os
+import shutil
 import sys
 import json
 import csv
 import time
 
-from rdflib import ConjunctiveGraph, Graph, RDF, URIRef
-from rdflib_jsonld.serializer import from_rdf
+from rdflib import BNode, ConjunctiveGraph, Graph, RDF, URIRef
+from rdflib_jsonld.context import Context
+from rdflib_jsonld.serializer import Converter
 from rdflib_jsonld.parser import to_rdf
 
+from . import __version__
 from . import lxlslug
+from .graphstore import read_triples, write_triples
 
 
 class Compiler:
@@ -44,6 +60,16 @@ class Compiler:
         self.context = context
         self.cachedir = None
         self.union = union
+        self.jobs = 1
+        self.force = False
+        self.refresh_construct = False
+        self.update_sources = False
+        self.write_files = True
+        self.sinks = []
+        self.manifest = {}
+        self.record_ids = {}
+        self.record_id_collisions = []
+        self._build_entry = None
 
     def main(self):
         argp = argparse.ArgumentParser(
@@ -55,28 +81,59 @@ class Compiler:
         arg('-c', '--cache', type=str, default=self.path("cache"), help="Cache directory")
         arg('-l', '--lines', action='store_true',
                 help="Output a single file with one JSON-LD document per line")
+        arg('-z', '--compress', choices=sorted(COMPRESSORS), default=None,
+                help="Compress the file with one JSON-LD document per line")
+        arg('--no-files', action='store_true',
+                help="Do not output a separate file per JSON-LD document")
+        arg('-j', '--jobs', type=int, default=1,
+                help="Number of datasets to compile in parallel")
+        arg('-f', '--force', action='store_true',
+                help="Rebuild datasets even if their inputs are unchanged")
+        arg('--refresh-construct', action='store_true',
+                help="Rerun construct queries instead of using cached results")
+        arg('-u', '--update-sources', action='store_true',
+                help="Revalidate cached remote sources before compiling")
         arg('datasets', metavar='DATASET', nargs='*')
 
         args = argp.parse_args()
+        if args.no_files and not (args.lines or args.compress):
+            argp.error("--no-files requires -l/--lines or -z/--compress")
         if not args.datasets and args.outdir:
             args.datasets = list(self.datasets)
 
-        self._configure(args.outdir, args.cache, args.system_base_iri, use_union=args.lines)
+        self.refresh_construct = args.refresh_construct
+        self.update_sources = args.update_sources
+        self._configure(args.outdir, args.cache, args.system_base_iri,
+                        use_union=args.lines or bool(args.compress), jobs=args.jobs,
+                        force=args.force, write_files=not args.no_files,
+                        compression=args.compress)
         self._run(args.datasets)
 
-    def _configure(self, outdir, cachedir=None, system_base_iri=None, use_union=False):
+    def _configure(self, outdir, cachedir=None, system_base_iri=None, use_union=False,
+                   jobs=1, force=False, write_files=True, compression=None):
         if system_base_iri:
             self.system_base_iri = system_base_iri
+        self.jobs = jobs
+        self.force = force
         self.outdir = Path(outdir)
-        self.cachedir = cachedir
+        self.cachedir = Path(cachedir) if cachedir else None
         if use_union:
             union_fpath = self.outdir / self.union
             union_fpath.parent.mkdir(parents=True, exist_ok=True)
-            self.union_file = union_fpath.open('wt', encoding='utf-8')
+            self.union_file = _open_output(union_fpath, compression)
         else:
             self.union_file = None
+        self.write_files = write_files
+        self.sinks = [FilesSink(self.outdir)] if write_files else []
 
     def _run(self, names):
+        self.manifest = self._load_manifest()
+        self.record_ids = {}
+        self.record_id_collisions = []
+        if self.cachedir:
+            self.prefetch([url for name in names
+                           for url in self.manifest.get(name, {}).get('sources', ())],
+                          revalidate=self.update_sources)
         try:
             self._compile_datasets(names)
         finally:
@@ -100,10 +157,74 @@ class Compiler:
                          self.load_json(self.context))
 
     def _compile_datasets(self, names):
+        """
+        Compile the named datasets, skipping those whose code and recorded
+        inputs are unchanged since they were last built (see `_track_input`).
+        The union file gets the lines of all named datasets, in order.
+        """
+        announce = len(names) > 1
+        changed = [name for name in names if self.force or not self._is_unchanged(name)]
+        if self.jobs > 1 and len(changed) > 1:
+            entries = self._compile_in_pool(changed)
+        else:
+            entries = (self._compile_dataset(name, announce) for name in changed)
         for name in names:
-            build, as_dataset = self.datasets[name]
-            if len(names) > 1:
-                print("Dataset:", name)
+            if name in changed:
+                self.manifest[name] = next(entries)
+                self._save_manifest()
+            else:
+                if announce:
+                    print("Dataset:", name)
+                print("Unchanged")
+                print()
+            if self.union_file:
+                with self._get_union_part_path(name).open('rb') as fp:
+                    shutil.copyfileobj(fp, self.union_file)
+
+    def _compile_in_pool(self, names):
+        """
+        Compile datasets in forked worker processes, yielding their manifest
+        entries in the order of names. The progress output of each dataset is
+        collected in its worker, and written here in the same order.
+        """
+        global _worker_compiler
+        _worker_compiler = self
+        sys.stdout.flush()
+        try:
+            get_context = getattr(multiprocessing, 'get_context', None)
+            pool = (get_context('fork') if get_context else multiprocessing).Pool(
+                    min(self.jobs, len(names)))
+            try:
+                for output, entry, record_ids, collisions in pool.imap(
+                        _compile_in_worker, names):
+                    sys.stdout.write(output)
+                    self.record_id_collisions += collisions
+                    self._index_record_ids(record_ids.keys(), record_ids.values())
+                    yield entry
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            _worker_compiler = None
+
+    def _compile_dataset(self, name, announce=False):
+        """
+        Build and write a dataset, returning its manifest entry. Union lines
+        are written to a part file, to be added to the union file.
+        """
+        build, as_dataset = self.datasets[name]
+        if announce:
+            print("Dataset:", name)
+        sinks = self.sinks
+        if self.union_file:
+            union_part_path = self._get_union_part_path(name)
+            union_part_path.parent.mkdir(parents=True, exist_ok=True)
+            union_part = LinesSink(union_part_path.open('wb'))
+            self.sinks = sinks + [union_part]
+        self._build_entry = entry = {
+            'code': _get_code_hash(build), 'config': self._get_config_hash(),
+            'inputs': {}, 'outputs': [], 'sources': []}
+        try:
             result = build()
             if as_dataset:
                 base, created_time, data = result
@@ -115,26 +236,90 @@ class Compiler:
 
                 context, resultset = _partition_dataset(urljoin(self.dataset_id, base), data)
 
-                for key, node in resultset.items():
+                record_ids = self.generate_record_ids(created_ms,
+                        [node['@id'] for node in resultset.values()])
+                for (key, node), record_id in zip(resultset.items(), record_ids):
                     node = self._to_node_description(node,
-                            created_ms,
+                            record_id,
                             dataset=self.dataset_id,
                             source='/dataset/%s' % name)
                     self.write(node, key)
             print()
+        finally:
+            if self.union_file:
+                union_part.close()
+                self.sinks = sinks
+            self._build_entry = None
+        return entry
+
+    def _is_unchanged(self, name):
+        entry = self.manifest.get(name)
+        if not entry or entry['code'] != _get_code_hash(self.datasets[name][0]):
+            return False
+        if entry.get('config') != self._get_config_hash():
+            return False
+        for fpath, digest in entry['inputs'].items():
+            if not os.path.isfile(fpath) or _hash_file(fpath) != digest:
+                return False
+        if self.union_file and not self._get_union_part_path(name).exists():
+            return False
+        return not self.write_files or all(
+                (self.outdir / ("%s.jsonld" % key)).exists()
+                for key in entry['outputs'])
+
+    def _get_config_hash(self):
+        """
+        Hash the configuration affecting the output of every dataset.
+        """
+        config = [self.system_base_iri, self.dataset_id, self.record_thing_link,
+                  self.context, self.write_files]
+        return hashlib.sha1(json.dumps(config).encode('utf-8')).hexdigest()
+
+    def _track_input(self, fpath):
+        """
+        Record a file read by the dataset being built, with a hash of its
+        contents, in the manifest entry of the build.
+        """
+        if self._build_entry is not None:
+            self._build_entry['inputs'][unicode(fpath)] = _hash_file(fpath)
+
+    def _track_source(self, url):
+        """
+        Record a remote source used by the dataset being built, to be
+        prefetched before it is built again.
+        """
+        if self._build_entry is not None and url not in self._build_entry['sources']:
+            self._build_entry['sources'].append(url)
+
+    def _get_manifest_path(self):
+        return self.outdir / '.build' / 'manifest.json'
+
+    def _get_union_part_path(self, name):
+        return self.outdir / '.build' / ("%s.jsonld.lines" % name)
+
+    def _load_manifest(self):
+        manifest_path = self._get_manifest_path()
+        if not manifest_path.exists():
+            return {}
+        with manifest_path.open() as fp:
+            return json.load(fp)
 
-    def _to_node_description(self, node, datasource_created_ms, dataset=None, source=None):
-        assert self.record_thing_link not in node
+    def _save_manifest(self):
+        manifest_path = self._get_manifest_path()
+        manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = manifest_path.with_suffix('.tmp')
+        with tmp_path.open('wb') as fp:
+            fp.write(_serialize(self.manifest))
+        tmp_path.rename(manifest_path)
 
-        def faux_offset(s):
-            return sum(ord(c) * ((i+1) ** 2)  for i, c in enumerate(s))
+    def _to_node_description(self, node, record_id, dataset=None, source=None):
+        assert self.record_thing_link not in node
 
         node_id = node['@id']
-        created_ms = datasource_created_ms + faux_offset(node_id)
 
         record = OrderedDict()
         record['@type'] = 'Record'
-        record['@id'] = self.generate_record_id(created_ms, node_id)
+        record['@id'] = record_id
         record[self.record_thing_link] = {'@id': node_id}
 
         # Add provenance
@@ -160,42 +345,127 @@ class Compiler:
 
     def generate_record_id(self, created_ms, node_id):
         slug = lxlslug.librisencode(created_ms, lxlslug.checksum(node_id))
-        return urljoin(self.system_base_iri, slug)
+        record_id = urljoin(self.system_base_iri, slug)
+        self._index_record_ids([record_id], [node_id])
+        return record_id
+
+    def generate_record_ids(self, datasource_created_ms, node_ids):
+        """
+        Generate the record ids of nodes from a datasource created at the
+        given time, spreading their creation times by `lxlslug.faux_offset`.
+        """
+        slugs = lxlslug.encode_identifiers(datasource_created_ms, node_ids)
+        record_ids = [urljoin(self.system_base_iri, slug) for slug in slugs]
+        self._index_record_ids(record_ids, node_ids)
+        return record_ids
+
+    def _index_record_ids(self, record_ids, node_ids):
+        """
+        Add record ids to the index of ids generated in this run, reporting
+        any id already generated for another node. (Datasets skipped as
+        unchanged are not indexed.)
+        """
+        index = self.record_ids
+        for record_id, node_id in zip(record_ids, node_ids):
+            known_id = index.setdefault(record_id, node_id)
+            if known_id != node_id:
+                self.record_id_collisions.append((record_id, known_id, node_id))
+                print("Record id collision: <%s> for <%s> and <%s>" % (
+                      record_id, known_id, node_id), file=sys.stderr)
 
     def write(self, node, name):
         node_id = node.get('@id')
         if node_id:
             assert not node_id.startswith('_:')
-        if self.union_file:
-            line = json.dumps(node)
-            if isinstance(line, bytes):
-                line = line.decode('utf-8')
-            print(line, file=self.union_file)
-        # TODO: else: # don't write both to union_file and separate file
-        pretty_repr = _serialize(node)
-        if pretty_repr:
-            outfile = self.outdir / ("%s.jsonld" % name)
-            print("Writing:", outfile)
-            outfile.parent.mkdir(parents=True, exist_ok=True)
-            with outfile.open('wb') as fp:
-                fp.write(pretty_repr)
-        else:
-            print("No data")
+        output = SerializedNode(node)
+        for sink in self.sinks:
+            sink.write(output, name)
+        if self._build_entry is not None:
+            self._build_entry['outputs'].append(name)
 
     def get_cached_path(self, url):
         return self.cachedir / quote(url, safe="")
 
-    def cache_url(self, url):
+    def cache_url(self, url, accept=None):
         path = self.get_cached_path(url)
         if not path.exists():
-            with path.open('wb') as fp:
-                r = urlopen(url)
-                while True:
-                    chunk = r.read(1024 * 8)
-                    if not chunk: break
-                    fp.write(chunk)
+            self._fetch(url, accept)
+        self._track_source(url)
+        self._track_input(path)
         return path
 
+    def prefetch(self, urls, revalidate=False, max_workers=8):
+        """
+        Concurrently download the given URLs that are not yet cached, and if
+        revalidate is set, update cached copies that have changed (using
+        their ETag and Last-Modified headers). Failures are reported, and
+        leave any cached copy in place.
+        """
+        urls = [url for url in OrderedDict.fromkeys(urls)
+                if revalidate or not self.get_cached_path(url).exists()]
+        if not urls:
+            return
+
+        def fetch(url):
+            try:
+                return self._fetch(url)
+            except Exception as e:
+                print("Failed to fetch <%s>: %s" % (url, e), file=sys.stderr)
+
+        pool = ThreadPool(min(max_workers, len(urls)))
+        try:
+            for url, updated in zip(urls, pool.map(fetch, urls)):
+                if updated:
+                    print("Fetched:", url)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _fetch(self, url, accept=None):
+        """
+        Download url to its cached path, unless an existing cached copy is
+        still valid. The file is replaced atomically. Returns whether it was.
+        """
+        path = self.get_cached_path(url)
+        headers_path = path.with_name(path.name + '.headers.json')
+        headers = {}
+        if headers_path.exists():
+            with headers_path.open() as fp:
+                headers = json.load(fp)
+        request = Request(url)
+        accept = accept or headers.get('Accept')
+        if accept:
+            request.add_header('Accept', accept)
+        if path.exists():
+            if headers.get('ETag'):
+                request.add_header('If-None-Match', headers['ETag'])
+            if headers.get('Last-Modified'):
+                request.add_header('If-Modified-Since', headers['Last-Modified'])
+        try:
+            response = urlopen(request)
+        except HTTPError as e:
+            if e.code == 304:
+                return False
+            raise
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(path.name + '.tmp')
+        with closing(response):
+            with tmp_path.open('wb') as fp:
+                shutil.copyfileobj(response, fp, 1024 * 64)
+            info = response.info()
+        tmp_path.rename(path)
+
+        headers = {key: info.get(key)
+                   for key in ('ETag', 'Last-Modified', 'Content-Type')
+                   if info.get(key)}
+        if accept:
+            headers['Accept'] = accept
+        with tmp_path.open('wb') as fp:
+            fp.write(_serialize(headers))
+        tmp_path.rename(headers_path)
+        return True
+
     def cached_rdf(self, fpath):
         source = Graph()
         http = 'http://'
@@ -204,25 +474,186 @@ class Compiler:
         elif fpath.startswith(http):
             remotepath = fpath
             fpath = self.cachedir / (remotepath[len(http):] + '.ttl')
-            if not fpath.is_file():
-                fpath.parent.mkdir(parents=True, exist_ok=True)
-                source.parse(remotepath)
-                source.serialize(str(fpath), format='turtle')
-                return source
-            else:
+            raw_path = self.get_cached_path(remotepath)
+            if fpath.is_file() and (not raw_path.exists() or
+                    fpath.stat().st_mtime >= raw_path.stat().st_mtime):
+                self._track_source(remotepath)
+                self._track_input(fpath)
                 return source.parse(str(fpath), format='turtle')
+            raw_path = self.cache_url(remotepath, accept=RDF_ACCEPT)
+            source.parse(str(raw_path), publicID=remotepath,
+                         format=self._get_content_type(remotepath))
+            fpath.parent.mkdir(parents=True, exist_ok=True)
+            source.serialize(str(fpath), format='turtle')
+            return source
+        self._track_input(fpath)
         source.parse(str(fpath))
         return source
 
+    def _get_content_type(self, url):
+        path = self.get_cached_path(url)
+        headers_path = path.with_name(path.name + '.headers.json')
+        if headers_path.exists():
+            with headers_path.open() as fp:
+                content_type = json.load(fp).get('Content-Type')
+            if content_type:
+                return content_type.split(';')[0].strip()
+        return None
+
     def load_json(self, fpath):
-        with self.path(fpath).open() as fp:
+        fpath = self.path(fpath)
+        self._track_input(fpath)
+        with fpath.open() as fp:
             return json.load(fp)
 
     def read_csv(self, fpath, **kws):
-        return _read_csv(self.path(fpath), **kws)
+        fpath = self.path(fpath)
+        self._track_input(fpath)
+        return _read_csv(fpath, **kws)
+
+    def construct(self, sources, query=None, refresh=False):
+        """
+        Load sources into a dataset, and return the result of running the
+        construct query over it (or the loaded graph if there is no query).
+
+        Query results are cached in the cache directory, keyed by a hash of
+        the query and of the sources. Use refresh (or the compiler option
+        refresh_construct) to rerun the query.
+        """
+        return _construct(self, sources, query,
+                          refresh=refresh or self.refresh_construct)
 
-    def construct(self, sources, query=None):
-        return _construct(self, sources, query)
+
+class SerializedNode:
+    """
+    A node to write, serialized at most once in each form, for all sinks.
+    """
+
+    def __init__(self, node):
+        self.node = node
+        self._line = None
+        self._pretty = None
+
+    @property
+    def line(self):
+        """
+        >>> print(SerializedNode({'@id': '/a'}).line.decode('utf-8'), end='')
+        {"@id": "/a"}
+        """
+        if self._line is None:
+            line = json.dumps(self.node)
+            if not isinstance(line, bytes):
+                line = line.encode('utf-8')
+            self._line = line + b'\n'
+        return self._line
+
+    @property
+    def pretty(self):
+        if self._pretty is None:
+            self._pretty = _serialize(self.node)
+        return self._pretty
+
+
+class LinesSink:
+    """
+    Writes nodes as JSON lines to a binary stream.
+    """
+
+    def __init__(self, fp):
+        self.fp = fp
+
+    def write(self, output, name):
+        self.fp.write(output.line)
+
+    def close(self):
+        self.fp.close()
+
+
+class FilesSink:
+    """
+    Writes each node as pretty-printed JSON to a file named after it.
+    """
+
+    def __init__(self, outdir):
+        self.outdir = Path(outdir)
+
+    def write(self, output, name):
+        pretty_repr = output.pretty
+        if pretty_repr:
+            outfile = self.outdir / ("%s.jsonld" % name)
+            print("Writing:", outfile)
+            outfile.parent.mkdir(parents=True, exist_ok=True)
+            with outfile.open('wb') as fp:
+                fp.write(pretty_repr)
+        else:
+            print("No data")
+
+    def close(self):
+        pass
+
+
+def _open_zstd(fpath):
+    import zstandard
+    return zstandard.ZstdCompressor().stream_writer(open(fpath, 'wb'))
+
+
+COMPRESSORS = {
+    'gzip': ('.gz', lambda fpath: gzip.open(fpath, 'wb')),
+    'zstd': ('.zst', _open_zstd),
+}
+
+
+def _open_output(fpath, compression=None):
+    """
+    Open a buffered binary output stream, compressed if requested.
+    """
+    if not compression:
+        return fpath.open('wb')
+    suffix, open_compressed = COMPRESSORS[compression]
+    return open_compressed(unicode(fpath) + suffix)
+
+
+_worker_compiler = None
+
+
+def _compile_in_worker(name):
+    # Index the record ids of this dataset only, for the parent to merge
+    _worker_compiler.record_ids = {}
+    _worker_compiler.record_id_collisions = []
+    stdout = sys.stdout
+    sys.stdout = output = StringIO()
+    try:
+        entry = _worker_compiler._compile_dataset(name, announce=True)
+    finally:
+        sys.stdout = stdout
+    return (output.getvalue(), entry,
+            _worker_compiler.record_ids, _worker_compiler.record_id_collisions)
+
+
+def _get_code_hash(func):
+    """
+    Hash the source file defining func, so that changes to any helpers it
+    uses are noticed too.
+    """
+    try:
+        with open(inspect.getsourcefile(func), 'rb') as fp:
+            code = fp.read()
+    except (IOError, OSError, TypeError):
+        try:
+            code = inspect.getsource(func)
+        except (IOError, OSError, TypeError):
+            code = repr(func.__code__.co_code)
+    if isinstance(code, unicode):
+        code = code.encode('utf-8')
+    return hashlib.sha1(__version__.encode('ascii') + code).hexdigest()
+
+
+def _hash_file(fpath):
+    digest = hashlib.sha1()
+    with open(unicode(fpath), 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1024 * 64), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
 
 
 def _serialize(data):
@@ -234,6 +665,10 @@ def _serialize(data):
     return data
 
 
+RDF_ACCEPT = ("text/turtle, application/rdf+xml;q=0.9, "
+              "application/ld+json;q=0.8, */*;q=0.1")
+
+
 CSV_FORMATS = {'.csv': 'excel', '.tsv': 'excel-tab'}
 
 def _read_csv(fpath, encoding='utf-8'):
@@ -251,10 +686,18 @@ def _read_csv(fpath, encoding='utf-8'):
             yield {k: decode(v.strip()) for (k, v) in item.items() if v}
 
 
-def _construct(compiler, sources, query=None):
+def _construct(compiler, sources, query=None, refresh=False):
     dataset = ConjunctiveGraph()
     if not isinstance(sources, list):
         sources = [sources]
+    cache_path = None
+    if query and compiler.cachedir:
+        cache_path = (Path(compiler.cachedir) / 'construct' /
+                      (_get_construct_key(compiler, sources, query) + '.rdfb'))
+        if cache_path.exists() and not refresh:
+            g = Graph()
+            g.addN((s, p, o, g) for s, p, o in read_triples(unicode(cache_path)))
+            return g
     for sourcedfn in sources:
         source = sourcedfn['source']
         graph = dataset.get_context(URIRef(sourcedfn.get('dataset') or source))
@@ -272,63 +715,175 @@ def _construct(compiler, sources, query=None):
             graph += compiler.cached_rdf(source)
     if not query:
         return graph
+    compiler._track_input(compiler.path(query))
     with compiler.path(query).open() as fp:
         result = dataset.query(fp.read())
     g = Graph()
     for spo in result:
         g.add(spo)
+    if cache_path:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        write_triples(g, unicode(cache_path))
     return g
 
 
+def _get_construct_key(compiler, sources, query):
+    """
+    Hash a construct query and its sources. Files, and the cached copies of
+    remote sources, are hashed by contents and recorded as inputs of the
+    current build, as when they are read. Remote sources are also recorded
+    as sources of the build, to be revalidated before it is run again.
+    """
+    def hash_input(fpath):
+        compiler._track_input(fpath)
+        return _hash_file(fpath)
+
+    digest = hashlib.sha1(hash_input(compiler.path(query)).encode('ascii'))
+    for sourcedfn in sources:
+        source = sourcedfn['source']
+        parts = [sourcedfn.get('dataset')]
+        if isinstance(source, (dict, list)):
+            context_data = sourcedfn['context']
+            if not isinstance(context_data, list):
+                parts.append(hash_input(compiler.path(context_data)))
+                context_data = compiler.load_json(context_data)['@context']
+            parts += [hash_input(compiler.path(ctx)) if isinstance(ctx, unicode) else ctx
+                      for ctx in context_data]
+            parts.append(source)
+        elif isinstance(source, Graph):
+            parts.append(hashlib.sha1("\n".join(sorted(
+                " ".join(term.n3() for term in triple) for triple in source)
+                ).encode('utf-8')).hexdigest())
+        elif source.startswith('http://'):
+            compiler._track_source(source)
+            parts.append(source)
+            if compiler.cachedir:
+                raw_path = compiler.get_cached_path(source)
+                ttl_path = compiler.cachedir / (source[len('http://'):] + '.ttl')
+                for cached_path in [raw_path, ttl_path]:
+                    if cached_path.is_file():
+                        parts.append(hash_input(cached_path))
+                        break
+        else:
+            parts.append(hash_input(source))
+        digest.update(json.dumps(parts, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+
 def _to_jsonld(source, context_uri, contextobj):
-    data = from_rdf(source, context_data=contextobj)
-    data['@context'] = context_uri
-    _embed_singly_referenced_bnodes(data)
-    _expand_ids(data['@graph'], contextobj['@context'])
-    return data
+    converter = _GraphConverter(Context(contextobj), contextobj['@context'])
+    return {'@context': context_uri, '@graph': converter.convert_graph(source)}
 
 
-def _expand_ids(obj, pfx_map):
+RDF_FIRST, RDF_REST, RDF_NIL, RDF_TYPE, RDF_LIST = (
+        RDF.first, RDF.rest, RDF.nil, RDF.type, RDF.List)
+
+
+class _GraphConverter(Converter):
     """
-    Ensure @id values are in expanded form (i.e. full URIs).
+    Converts a graph to a list of JSON-LD nodes, sorted by id, in which node
+    references have expanded ids (i.e. full URIs), and blank nodes referenced
+    only once are embedded. The references are collected while converting,
+    so no further passes over the result are needed, and the graph is read
+    once into a `_GraphIndex`.
     """
-    if isinstance(obj, list):
-        for item in obj:
-            _expand_ids(item, pfx_map)
-    elif isinstance(obj, dict):
-        node_id = obj.get('@id')
-        if node_id:
+
+    def __init__(self, context, pfx_map):
+        super(_GraphConverter, self).__init__(context, False, False)
+        self.pfx_map = pfx_map
+        self._expanded_ids = {}
+        self._bnode_refs = {}
+
+    def convert_graph(self, graph):
+        self._bnode_refs = {}
+        id_key = self.context.id_key
+        nodes = self.from_graph(_GraphIndex(graph))
+        graph_index = {node[id_key]: node for node in nodes}
+        for refid, refs in self._bnode_refs.items():
+            if len(refs) == 1:
+                refs[0].update(graph_index.pop(refid))
+                refs[0].pop(id_key)
+        return sorted(graph_index.values(), key=lambda node: node[id_key])
+
+    def process_subject(self, graph, s, nodemap):
+        node = super(_GraphConverter, self).process_subject(graph, s, nodemap)
+        if node is not None and isinstance(s, URIRef):
+            node[self.context.id_key] = self._expand_id(s)
+        return node
+
+    def to_raw_value(self, graph, s, o, nodemap):
+        value = super(_GraphConverter, self).to_raw_value(graph, s, o, nodemap)
+        id_key = self.context.id_key
+        if isinstance(value, dict) and id_key in value:
+            if isinstance(o, URIRef):
+                value[id_key] = self._expand_id(o)
+            elif isinstance(o, BNode):
+                self._bnode_refs.setdefault(value[id_key], []).append(value)
+        return value
+
+    def to_collection(self, graph, l):
+        # Same as in Converter, but reading the index directly.
+        if l != RDF_NIL and not graph.value(l, RDF_FIRST):
+            return None
+        list_nodes = []
+        chain = set([l])
+        while l:
+            if l == RDF_NIL:
+                return list_nodes
+            if isinstance(l, URIRef):
+                return None
+            first, rest = None, None
+            for p, o in graph.by_subject.get(l, ()):
+                if not first and p == RDF_FIRST:
+                    first = o
+                elif not rest and p == RDF_REST:
+                    rest = o
+                elif p != RDF_TYPE or o != RDF_LIST:
+                    return None
+            list_nodes.append(first)
+            l = rest
+            if l in chain:
+                return None
+            chain.add(l)
+
+    def _expand_id(self, iri):
+        node_id = self._expanded_ids.get(iri)
+        if node_id is None:
+            node_id = self.context.shrink_iri(iri)
             pfx, colon, leaf = node_id.partition(':')
-            ns = pfx_map.get(pfx)
+            ns = self.pfx_map.get(pfx)
             if ns:
-                obj['@id'] = node_id.replace(pfx + ':', ns, 1)
-        for value in obj.values():
-            _expand_ids(value, pfx_map)
-
-
-def _embed_singly_referenced_bnodes(data):
-    graph_index = {item['@id']: item for item in data.pop('@graph')}
-    bnode_refs = {}
-
-    def collect_refs(node):
-        for values in node.values():
-            if not isinstance(values, list):
-                values = [values]
-            for value in values:
-                if isinstance(value, dict):
-                    if value.get('@id', '').startswith('_:'):
-                        bnode_refs.setdefault(value['@id'], []).append(value)
-                    collect_refs(value)
-
-    for node in graph_index.values():
-        collect_refs(node)
-
-    for refid, refs in bnode_refs.items():
-        if len(refs) == 1:
-            refs[0].update(graph_index.pop(refid))
-            refs[0].pop('@id')
-
-    data['@graph'] = sorted(graph_index.values(), key=lambda node: node['@id'])
+                node_id = node_id.replace(pfx + ':', ns, 1)
+            self._expanded_ids[iri] = node_id
+        return node_id
+
+
+class _GraphIndex:
+    """
+    Indexes of the triples of a graph by subject and by object, answering
+    the graph lookups made by `Converter`.
+    """
+
+    def __init__(self, graph):
+        self.by_subject = {}
+        self.by_object = {}
+        for s, p, o in graph:
+            self.by_subject.setdefault(s, []).append((p, o))
+            self.by_object.setdefault(o, []).append(s)
+
+    def subjects(self, predicate=None, object=None):
+        assert predicate is None
+        if object is None:
+            return iter(self.by_subject)
+        return iter(self.by_object.get(object, ()))
+
+    def predicate_objects(self, subject):
+        return iter(self.by_subject.get(subject, ()))
+
+    def value(self, subject, predicate):
+        for p, o in self.by_subject.get(subject, ()):
+            if p == predicate:
+                return o
 
 
 def _partition_dataset(base, data):
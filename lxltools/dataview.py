@@ -3,10 +3,19 @@ from __future__ import unicode_literals, print_function
 __metaclass__ = type
 
 from collections import OrderedDict, namedtuple
+import heapq
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+from threading import Lock
+import json
+import os
 import re
-from urllib import quote as url_quote
+import time
+from urllib import quote as url_quote, urlencode
 
 from .util import as_iterable
+from .cache import ChipCache, DecoratedCache, LRUCache, StatsCache
+from .tracing import default_tracer, traced
 from .ld.keys import *
 from .ld.frame import autoframe
 
@@ -17,14 +26,92 @@ DEFAULT_LIMIT = 200
 
 class DataView:
 
-    def __init__(self, vocab, storage, elastic, es_index):
+    def __init__(self, vocab, storage, elastic, es_index, chip_cache=None,
+            max_workers=None, request_timeout=None, stats_cache=None,
+            decorated_cache=None, tracer=None, missing_ttl=300):
         self.vocab = vocab
         self.storage = storage
         self.elastic = elastic
         self.es_index = es_index
         self.rev_limit = 4000
+        self.ambiguity_scan_limit = MAX_LIMIT
+        # At most this many times the requested page window of the best
+        # candidates are ranked by reference count.
+        self.ambiguity_rank_factor = 2
         self.chip_keys = {ID, TYPE, 'focus', 'mainEntity', 'sameAs', 'isDefinedBy', 'inScheme', 'inCollection'} | set(self.vocab.label_keys)
-        self.reserved_parameters = ['q', 'limit', 'offset', 'p', 'o', 'value']
+        self.reserved_parameters = ['q', 'limit', 'offset', 'p', 'o', 'value', 'after']
+        # A stable order is needed to page with search_after cursors.
+        self.search_sort = [{'_score': 'desc'}, {ID: 'asc'}]
+        self.chip_cache = chip_cache if chip_cache is not None else ChipCache()
+        # Concurrent mode: run independent lookups on a bounded thread pool,
+        # giving up on anything not done within request_timeout seconds.
+        self.max_workers = max_workers
+        self._pool = None
+        self._pool_pid = None
+        self._pool_lock = Lock()
+        self.request_timeout = request_timeout
+        self.stats_cache = stats_cache if stats_cache is not None else StatsCache(
+                get_generation=self.get_index_generation,
+                on_thread_exit=getattr(storage, 'release_connection', None))
+        self.decorated_cache = (decorated_cache if decorated_cache is not None
+                                else DecoratedCache())
+        self.last_change = None
+        self._following_changes = False
+        # Ids which did not resolve in storage, to not look them up again
+        # until missing_ttl seconds have passed.
+        self.missing_ids = LRUCache(maxsize=10000, ttl=missing_ttl)
+        self.tracer = tracer or default_tracer
+
+    def get_timings(self):
+        """
+        Get the timing breakdown of the last request handled in this thread.
+        """
+        return self.tracer.last_request()
+
+    def get_metrics(self):
+        return self.tracer.format_metrics()
+
+    def get_cache_stats(self):
+        return {'chips': self.chip_cache.stats(),
+                'decorated': self.decorated_cache.stats(),
+                'missing': self.missing_ids.stats()}
+
+    def follow_changes(self, batch_size=1000):
+        """
+        Read changes made in storage since the last call, a batch at a time,
+        and drop any cached views made stale by them. Returns the number of
+        changes read.
+
+        The first call only notes the last change in storage, so call this
+        once before serving any views.
+        """
+        if not self._following_changes:
+            self.last_change = self.storage.get_last_change()
+            self._following_changes = True
+            return 0
+        count = 0
+        while True:
+            changes = self.storage.find_changes(self.last_change, limit=batch_size)
+            if changes:
+                last = changes[-1][0]
+                self.last_change = (last.modified, last.identifier)
+            self.apply_changes(changes)
+            count += len(changes)
+            if len(changes) < batch_size:
+                return count
+
+    def apply_changes(self, changes):
+        for record, deleted in changes:
+            entry, items, quoted = get_descriptions(record.data)
+            for item in [entry] + items:
+                if ID in item:
+                    for item_id in get_aliases(item):
+                        self.chip_cache.invalidate(item_id)
+                        self.missing_ids.pop(item_id)
+            quoted_ids = []
+            for quote in quoted:
+                quoted_ids += get_aliases(quote[GRAPH])
+            self.decorated_cache.invalidate(record.identifier, *quoted_ids)
 
     def get_record_data(self, item_id):
         record = self.storage.get_record(item_id)
@@ -40,7 +127,39 @@ class DataView:
         if records:
             return records[0].identifier
 
+    @traced('dataview.get_search_results', request=True)
     def get_search_results(self, req_args, make_find_url, site_base_uri=None):
+        results, items = self._get_search_view(req_args, make_find_url,
+                site_base_uri)
+        stats = results.pop('stats', None)
+
+        # hydra:member
+        results['items'] = list(items)
+
+        if stats:
+            results['stats'] = stats
+
+        return results
+
+    def iter_search_results(self, req_args, make_find_url, site_base_uri=None):
+        """
+        Generate the search results as JSON text: first the collection view
+        without its items, then one item at a time, read lazily from the
+        storage cursor or ES hits. The request span is open until the last
+        item is generated.
+        """
+        with self.tracer.request('dataview.iter_search_results'):
+            results, items = self._get_search_view(req_args, make_find_url,
+                    site_base_uri, stream=True)
+            envelope = json.dumps(results)
+            yield envelope[:-1] + ', "items": ['
+            items = self.tracer.iterate('dataview.items', items)
+            for i, item in enumerate(items):
+                yield (', ' if i else '') + json.dumps(item)
+            yield ']}'
+
+    def _get_search_view(self, req_args, make_find_url, site_base_uri=None,
+            stream=False):
         #s = req_args.get('s')
         p = req_args.get('p')
         o = req_args.get('o')
@@ -48,13 +167,16 @@ class DataView:
         #language = req_args.get('language')
         #datatype = req_args.get('datatype')
         q = req_args.get('q')
+        after = req_args.get('after')
         limit, offset = self._get_limit_offset(req_args)
         if not isinstance(offset, (int, long)):
             offset = 0
+        deadline = self._get_deadline()
 
         total = None
+        next_cursor = None
         records = []
-        items = []
+        items = ()
         stats = None
         page_params = {'p': p, 'o': o, 'value': value, 'q': q, 'limit': limit}
 
@@ -75,13 +197,17 @@ class DataView:
         # TODO: unify find_by_relation and find_by_example, support the latter form here too
         if p:
             if o:
-                records = self.storage.find_by_relation(p, o, limit, offset)
+                records = self.storage.find_by_relation(p, o, limit, offset,
+                        stream=stream)
             elif value:
-                records = self.storage.find_by_value(p, value, limit, offset)
+                records = self.storage.find_by_value(p, value, limit, offset,
+                        stream=stream)
             elif q:
-                records = self.storage.find_by_query(p, q, limit, offset)
+                records = self.storage.find_by_query(p, q, limit, offset,
+                        stream=stream)
         elif o:
-            records = self.storage.find_by_quotation(o, limit, offset)
+            records = self.storage.find_by_quotation(o, limit, offset,
+                    stream=stream)
         elif q and not p:
             # Search in elastic
 
@@ -113,8 +239,14 @@ class DataView:
                     "bool": {
                         "must": musts,
                     }
-                }
+                },
+                "_source": self.get_chip_source_fields(),
+                "sort": self.search_sort
             }
+            es_offset = offset
+            if after:
+                dsl['search_after'] = decode_cursor(after)
+                es_offset = 0
             if site_base_uri:
                 dsl['query']['bool'].update(self._make_site_filter(site_base_uri))
 
@@ -122,20 +254,23 @@ class DataView:
             if statstree:
                 dsl["aggs"] = self.build_agg_query(statstree)
 
-            # TODO: only ask ES for chip properties instead of post-processing
-            es_results = self.elastic.search(body=dsl, size=limit, from_=offset,
+            es_results = self._search(deadline, body=dsl, size=limit, from_=es_offset,
                              index=self.es_index)
             hits = es_results.get('hits')
             total = hits.get('total')
-            items = [self.to_chip(r.get('_source')) for r in
-                     hits.get('hits')]
+            items = (self.cache_chip(r.get('_source')) for r in
+                     hits.get('hits'))
+            if hits.get('hits') and len(hits['hits']) == limit:
+                next_cursor = encode_cursor(hits['hits'][-1].get('sort'))
             if statstree:
                 stats = self.build_stats(es_results, make_find_url,
-                        dict(req_args, offset=None))
+                        dict(req_args, offset=None, after=None), deadline)
 
-        for rec in records:
-            chip = self.to_chip(self.get_decorated_data(rec.data, include_quoted=False))
-            items.append(chip)
+        if records:
+            items = (self.cache_chip(
+                        self.get_decorated_record(rec, include_quoted=False),
+                        rec.modified)
+                     for rec in records)
 
         def ref(link): return {ID: link}
 
@@ -167,15 +302,20 @@ class DataView:
                 results['previous'] = ref(make_find_url(offset=offsets.prev, **page_params))
 
         if offsets.next is not None:
-            results['next'] = ref(make_find_url(offset=offsets.next, **page_params))
-
-        # hydra:member
-        results['items'] = items
+            if next_cursor:
+                results['next'] = ref(make_find_url(offset=offsets.next,
+                        after=next_cursor, **page_params))
+            else:
+                results['next'] = ref(make_find_url(offset=offsets.next, **page_params))
 
         if stats:
             results['stats'] = stats
 
-        return results
+        return results, items
+
+    def get_chip_source_fields(self):
+        # NOTE: modified is needed to cache the chips made from the hits
+        return sorted(self.chip_keys | {'modified'}) + ['*ByLang']
 
     def _get_limit_offset(self, args):
         limit = args.get('limit')
@@ -189,8 +329,29 @@ class DataView:
     def get_real_limit(self, limit=None):
         return DEFAULT_LIMIT if limit is None or limit > MAX_LIMIT else limit
 
+    @traced('dataview.get_index_stats', request=True)
     def get_index_stats(self, slicetree, make_find_url, site_base_uri):
         slicetree = slicetree or {'@type':[]}
+        key = json.dumps([site_base_uri, slicetree], sort_keys=True)
+        return self.stats_cache.get(key, lambda: self._build_index_stats(
+            slicetree, make_find_url, site_base_uri))
+
+    def warm_index_stats(self, slicetree, make_find_url, site_base_uri):
+        """
+        Build index statistics in the background, e.g. at startup, so that no
+        request has to wait for them.
+        """
+        slicetree = slicetree or {'@type':[]}
+        key = json.dumps([site_base_uri, slicetree], sort_keys=True)
+        self.stats_cache.refresh(key, lambda: self._build_index_stats(
+            slicetree, make_find_url, site_base_uri))
+
+    def get_index_generation(self):
+        stats = self.elastic.indices.stats(index=self.es_index, metric='indexing')
+        indexing = stats['_all']['primaries']['indexing']
+        return indexing['index_total'] + indexing['delete_total']
+
+    def _build_index_stats(self, slicetree, make_find_url, site_base_uri):
         dsl = {
             "size": 0,
             "query" : {},
@@ -201,9 +362,11 @@ class DataView:
         else:
             dsl['query']['match_all'] = {}
 
-        results = self.elastic.search(body=dsl, size=dsl['size'],
+        deadline = self._get_deadline()
+        results = self._search(deadline, body=dsl, size=dsl['size'],
                 index=self.es_index)
-        stats = self.build_stats(results, make_find_url, {'limit': self.get_real_limit()})
+        stats = self.build_stats(results, make_find_url, {'limit': self.get_real_limit()},
+                deadline)
 
         return {TYPE: 'DataCatalog', ID: site_base_uri, 'statistics': stats}
 
@@ -217,7 +380,22 @@ class DataView:
                 query[key]['aggs'] = self.build_agg_query(tree[key], size)
         return query
 
-    def build_stats(self, results, make_find_url, req_args):
+    @traced('dataview.build_stats')
+    def build_stats(self, results, make_find_url, req_args, deadline=None):
+        def collect_keys(aggregations, keys):
+            for agg in aggregations.values():
+                for bucket in agg['buckets']:
+                    keys.append(bucket['key'])
+                    collect_keys(dict((k, v) for k, v in bucket.items()
+                                      if isinstance(v, dict) and 'buckets' in v),
+                                 keys)
+            return keys
+
+        item_ids = list(OrderedDict.fromkeys(
+            collect_keys(results['aggregations'], [])))
+        objects = dict(zip(item_ids, self._map(self.lookup, item_ids, deadline,
+                                               fallback=_placeholder)))
+
         def add_slices(stats, aggregations, base):
             slice_map = {}
 
@@ -238,7 +416,7 @@ class DataView:
                     observation = {
                         'totalItems': bucket.pop('doc_count'),
                         'view': {ID: search_page_url},
-                        'object': self.lookup(item_id)
+                        'object': objects[item_id]
                     }
                     observations.append(observation)
 
@@ -256,6 +434,52 @@ class DataView:
 
         return stats
 
+    def _get_deadline(self):
+        if self.request_timeout:
+            return time.time() + self.request_timeout
+
+    def _search(self, deadline, **kws):
+        if deadline:
+            kws['request_timeout'] = max(deadline - time.time(), 0)
+        with self.tracer.span('es.search'):
+            return self.elastic.search(**kws)
+
+    @property
+    def pool(self):
+        """
+        The thread pool of this process, if max_workers is set. It is created
+        on first use, since pool threads do not survive a (prefork) fork.
+        """
+        if not self.max_workers:
+            return None
+        with self._pool_lock:
+            if self._pool is None or self._pool_pid != os.getpid():
+                self._pool = ThreadPool(self.max_workers)
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    def _map(self, func, items, deadline=None, fallback=None):
+        """
+        Apply func to each item, in parallel if a pool is configured. Results
+        not ready by the deadline are replaced by fallback(item), or raise
+        TimeoutError if no fallback is given.
+        """
+        pool = self.pool if len(items) > 1 else None
+        if not pool:
+            return [func(item) for item in items]
+        func = self.tracer.bind(func)
+        pending = [pool.apply_async(func, (item,)) for item in items]
+        results = []
+        for item, result in zip(items, pending):
+            timeout = max(deadline - time.time(), 0) if deadline else None
+            try:
+                results.append(result.get(timeout))
+            except TimeoutError:
+                if fallback is None:
+                    raise
+                results.append(fallback(item))
+        return results
+
     def _make_site_filter(self, site_base_uri):
         return {
             "should": [
@@ -265,22 +489,42 @@ class DataView:
             "minimum_should_match": 1
         }
 
+    @traced('dataview.lookup')
     def lookup(self, item_id):
         if item_id in self.vocab.index:
             return self.vocab.index[item_id]
-        else:
-            data = self.get_record_data(item_id)
-            if data:
-                return get_descriptions(data).entry if data else None
-        return {ID: item_id, 'label': item_id}
+        cached = self.chip_cache.get(item_id)
+        if cached:
+            return cached.chip
+        if self.missing_ids.get(item_id):
+            return _placeholder(item_id)
+        record = self.storage.get_record(item_id)
+        if record:
+            entry = get_descriptions(record.data).entry
+            return self.cache_chip(entry, record.modified, item_id)
+        self.missing_ids.set(item_id, True)
+        return _placeholder(item_id)
 
+    @traced('dataview.find_ambiguity', request=True)
     def find_ambiguity(self, request):
+        """
+        Find things matching the request arguments, ranked by how well their
+        labels match `q` and then by how often they are referenced. Returns
+        a page of at most `limit` candidates from `offset`, with a link to
+        the next page if there are more. At most `ambiguity_scan_limit`
+        candidates are scanned, so `totalItems` is a lower bound when that
+        many are found.
+        """
         kws = dict(request.args)
         rtype = kws.pop('type', None)
         q = kws.pop('q', None)
+        limit = kws.pop('limit', [None])[0]
+        offset = kws.pop('offset', [None])[0]
+        limit, offset = self._get_limit_offset({'limit': limit, 'offset': offset})
+        if not isinstance(offset, (int, long)):
+            offset = 0
         if q:
             q = " ".join(q)
-            #parts = _tokenize(q)
         example = {}
         if rtype:
             rtype = rtype[0]
@@ -295,26 +539,78 @@ class DataView:
                 if rtype in as_iterable(item[TYPE]):
                     return item
 
-        maybes  = [pick_thing(rec) #self.get_decorated_data(rec)
-                   for rec in self.storage.find_by_example(example,
-                           limit=MAX_LIMIT)]
+        # Rank by label match while streaming, keeping a bounded heap of the
+        # best candidates (the earliest of equal matches) to rank by
+        # references, e.g. if every candidate is an exact match.
+        query_tokens = _tokenize(q) if q else []
+        window = offset + limit
+        heap_size = self.ambiguity_rank_factor * window
+        best = []
+        total = 0
+        for rec in self.storage.find_by_example(example,
+                limit=self.ambiguity_scan_limit, stream=True):
+            thing = pick_thing(rec)
+            if not thing:
+                continue
+            total += 1
+            match = _label_match(query_tokens, self.getlabel(thing))
+            entry = (match, -total, thing)
+            if len(best) < heap_size:
+                heapq.heappush(best, entry)
+            elif entry > best[0]:
+                heapq.heapreplace(best, entry)
+        best.sort(key=lambda c: -c[1])
+        candidates = [(match, thing[ID], thing) for match, seq, thing in best]
+
+        ref_counts = self.storage.count_quotations([c[1] for c in candidates])
+        candidates.sort(key=lambda c: (c[0], ref_counts.get(c[1], 0)), reverse=True)
+        maybes = [thing for match, thing_id, thing in candidates[offset:window]]
+
+        if not maybes:
+            return None
 
         some_id = '%s?%s' % (request.path, request.query_string)
         item = {
             "@id": some_id,
             "@type": "Ambiguity",
             "label": q or ",".join(example.values()),
-            "maybe": maybes
+            "maybe": maybes,
+            "itemOffset": offset,
+            "totalItems": total
         }
-
-        references = self._get_references_to(item)
-
-        if not maybes and not references:
-            return None
-
-        return {GRAPH: [item] + references}
-
-    def get_decorated_data(self, data, add_references=False, include_quoted=True):
+        if total > window:
+            params = [(k.encode('utf-8'), v.encode('utf-8'))
+                      for k, vs in dict(request.args).items() if k != 'offset'
+                      for v in vs]
+            item['next'] = {ID: '%s?%s' % (request.path,
+                                          urlencode(params + [('offset', window)]))}
+
+        return {GRAPH: [item]}
+
+    @traced('dataview.get_decorated_record', request=True)
+    def get_decorated_record(self, record, add_references=False, include_quoted=True):
+        """
+        Get the decorated data of a stored record, cached by record version.
+        """
+        variant = '%d%d' % (add_references, include_quoted)
+        cached = self.decorated_cache.get(record.identifier, variant, record.modified)
+        if cached is not None:
+            return cached
+        referrers = []
+        data = self.get_decorated_data(record.data, add_references,
+                include_quoted, referrers)
+        depends_on = []
+        if add_references:
+            descriptions = get_descriptions(record.data)
+            main_item = descriptions.entry or descriptions.items[0]
+            depends_on = get_aliases(main_item) + referrers
+        self.decorated_cache.put(record.identifier, variant, record.modified,
+                data, depends_on)
+        return data
+
+    @traced('dataview.get_decorated_data')
+    def get_decorated_data(self, data, add_references=False, include_quoted=True,
+            referrers=None):
         entry, other, quoted = get_descriptions(data)
 
         main_item = entry if entry else other.pop(0) if other else None
@@ -334,53 +630,76 @@ class DataView:
                     for ngraph in quoted]
             items += unquoted
 
-        framed = autoframe({GRAPH: items}, main_id)
+        with self.tracer.span('frame'):
+            framed = autoframe({GRAPH: items}, main_id)
         if framed:
-            refs = self._get_references_to(main_item) if add_references else []
+            refs = self._get_references_to(main_item, referrers) if add_references else []
             # NOTE: workaround for autoframing frailties
             refs = [ref for ref in refs if ref[ID] != main_id]
-            framed.update(autoframe({GRAPH: [{ID: main_id}] + refs}, main_id))
+            with self.tracer.span('frame'):
+                framed.update(autoframe({GRAPH: [{ID: main_id}] + refs}, main_id))
             return framed
         else:
             return data
 
 
     def getlabel(self, item):
-        # TODO: get and cache chip for item (unless already quotedFrom)...
+        if 'quotedFromGraph' not in item and ID in item:
+            label = self.chip_cache.get_label(item[ID])
+            if label:
+                return label
         return self.vocab.get_label_for(item) or ",".join(v for k, v in item.items()
                 if k[0] != '@' and isinstance(v, unicode)) or item[ID]
                 #or getlabel(self.get_chip(item[ID]))
 
+    def cache_chip(self, item, modified=None, item_id=None):
+        """
+        Make a chip of the item and keep it, with its label, in the chip cache.
+        """
+        chip = self.to_chip(item)
+        item_id = item_id or item.get(ID)
+        if item_id:
+            self.chip_cache.put(item_id, chip, self.vocab.get_label_for(item),
+                    modified or item.get('modified'))
+        return chip
+
     def to_chip(self, item, *keep_refs):
         return {k: v for k, v in item.items()
                 if k in self.chip_keys or k.endswith('ByLang')
                    or has_ref(v, *keep_refs)}
 
-    def _get_references_to(self, item):
+    @traced('dataview.get_references_to')
+    def _get_references_to(self, item, referrers=None):
         item_id = item[ID]
-        # TODO: send choice of id:s to find_by_quotation?
-        ids = [item_id]
-        same_as = item.get('sameAs')
-        if same_as:
-            ids.append(same_as[0].get(ID))
+        aliases = get_aliases(item)
 
         references = []
-        for quoted_id in ids:
-            if references:
-                break
-            for quoting in self.storage.find_by_quotation(quoted_id, limit=200):
-                qdesc = get_descriptions(quoting.data)
-                if quoted_id != item_id:
-                    _fix_refs(item_id, quoted_id, qdesc)
-                references.append(self.to_chip(qdesc.entry, item_id, quoted_id))
-                for it in qdesc.items:
-                    references.append(self.to_chip(it, item_id, quoted_id))
+        for quoting in self.storage.find_by_quotation(aliases, limit=200):
+            qdesc = get_descriptions(quoting.data)
+            _fix_refs(item_id, aliases, qdesc)
+            self.cache_chip(qdesc.entry, quoting.modified)
+            if referrers is not None:
+                referrers.append(quoting.identifier)
+            references.append(self.to_chip(qdesc.entry, item_id))
+            for it in qdesc.items:
+                references.append(self.to_chip(it, item_id))
 
         return references
 
 
 Descriptions = namedtuple('Descriptions', 'entry, items, quoted')
 
+def get_aliases(item):
+    """
+    >>> get_aliases({ID: '/a', 'sameAs': [{ID: '/b'}]}) == ['/a', '/b']
+    True
+    """
+    return [item[ID]] + [same[ID] for same in as_iterable(item.get('sameAs'))
+                         if ID in same]
+
+def _placeholder(item_id):
+    return {ID: item_id, 'label': item_id}
+
 def get_descriptions(data):
     if 'descriptions' in data:
         return Descriptions(**data['descriptions'])
@@ -398,18 +717,22 @@ def get_descriptions(data):
 
 # FIXME: quoted id:s are temporary and should be replaced with canonical id (or
 # *at least* sameAs id) in stored data
-def _fix_refs(real_id, ref_id, descriptions):
+def _fix_refs(real_id, ref_ids, descriptions):
     entry, items, quoted = descriptions
     alias_map = {}
     for quote in quoted:
         item = quote[GRAPH]
         alias = item[ID]
-        if alias == ref_id:
+        if alias == real_id:
+            continue
+        if alias in ref_ids:
             alias_map[alias] = real_id
         else:
             for same_as in as_iterable(item.get('sameAs')):
-                if same_as[ID] == ref_id:
+                if same_as[ID] in ref_ids:
                     alias_map[alias] = real_id
+    if not alias_map:
+        return
 
     _fix_ref(entry, alias_map)
     for item in items:
@@ -446,6 +769,21 @@ def has_ref(vs, *refs):
     return False
 
 
+def _label_match(query_tokens, label):
+    """
+    Rank how well a label matches query tokens: an exact token match first,
+    then by the number of shared tokens, then by fewest extra tokens.
+
+    >>> query = _tokenize("Some One")
+    >>> _label_match(query, "One, Some") > _label_match(query, "Some One Else")
+    True
+    >>> _label_match(query, "Some One Else") > _label_match(query, "Some Other")
+    True
+    """
+    tokens = set(_tokenize(label or ""))
+    query = set(query_tokens)
+    return (tokens == query, len(tokens & query), -len(tokens - query))
+
 def _tokenize(stuff):
     """
     >>> print(" ".join(_tokenize("One, Any (1911-)")))
@@ -456,6 +794,23 @@ def _tokenize(stuff):
         for part in stuff.split(" ")))
 
 
+def encode_cursor(sort_values):
+    """
+    >>> print(encode_cursor([1.5, '/some']))
+    [1.5,"/some"]
+    >>> encode_cursor(None)
+    """
+    if sort_values:
+        return json.dumps(sort_values, separators=(',', ':'))
+
+def decode_cursor(cursor):
+    """
+    >>> decode_cursor('[1.5,"/some"]') == [1.5, '/some']
+    True
+    """
+    return json.loads(cursor)
+
+
 Offsets = namedtuple('Offsets', 'prev, next, last')
 
 def compute_offsets(total, limit, offset):
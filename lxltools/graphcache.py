@@ -1,10 +1,13 @@
 import os
 import sys
+import json
 import urllib2
 import logging
+from multiprocessing import Pool, cpu_count
 from rdflib import ConjunctiveGraph, Graph
 from rdflib.parser import create_input_source
 from rdflib.util import guess_format, SUFFIX_FORMAT_MAP
+from .graphstore import SQLiteStore, read_triples, write_triples
 
 
 SUFFIX_FORMAT_MAP['jsonld'] = 'json-ld'
@@ -19,44 +22,162 @@ vocab_source_map = {
 
 
 class GraphCache(object):
+    """
+    Loads vocabularies and remote schemas into one graph, keeping fetched
+    sources in cachedir in a binary format (see `graphstore.write_triples`),
+    and optionally also as Turtle (which is read if there is no binary copy).
 
-    def __init__(self, cachedir):
-        self.graph = ConjunctiveGraph()
-        self.mtime_map = {}
+    If persistent, the graph is kept in an SQLite store in cachedir, along
+    with the modification times of the loaded local files. Contexts are then
+    reused between runs, and only changed files are parsed again.
+    """
+
+    STORE_FILE = 'graphcache.sqlite'
+    MTIME_MAP_FILE = 'mtime_map.json'
+
+    def __init__(self, cachedir, persistent=False, turtle_sidecar=False):
         self.cachedir = cachedir
         if not os.path.isdir(cachedir):
             os.makedirs(cachedir)
+        self.turtle_sidecar = turtle_sidecar
+        self.persistent = persistent
+        if persistent:
+            self.graph = ConjunctiveGraph(SQLiteStore())
+            self.graph.open(os.path.join(cachedir, self.STORE_FILE), create=True)
+            self.mtime_map = self._load_mtime_map()
+        else:
+            self.graph = ConjunctiveGraph()
+            self.mtime_map = {}
+
+    def close(self):
+        if self.persistent:
+            self.graph.close(commit_pending_transaction=True)
 
     def load(self, url):
         if os.path.isfile(url):
             context_id = create_input_source(url).getPublicId()
-            last_vocab_mtime = self.mtime_map.get(url)
-            vocab_mtime = os.stat(url).st_mtime
-            if not last_vocab_mtime or last_vocab_mtime < vocab_mtime:
+            if self._is_changed(url):
                 logger.debug("Parse file: '%s'", url)
-                self.mtime_map[url] = vocab_mtime
-                # use CG as workaround for json-ld always loading as dataset
-                graph = ConjunctiveGraph()
-                graph.parse(url, format=guess_format(url))
-                self.graph.remove_context(context_id)
-                for s, p, o in graph:
-                    self.graph.add((s, p, o, context_id))
+                self.mtime_map[url] = os.stat(url).st_mtime
+                parsed_path = self._get_cache_path(url) + '.rdfb'
+                if _is_newer(parsed_path, url):
+                    triples = read_triples(parsed_path)
+                else:
+                    triples = _parse(url)
+                    write_triples(triples, parsed_path)
+                graph = self.replace_context(context_id, triples)
+                self._commit()
                 return graph
         else:
             context_id = url
 
-        if any(self.graph.triples((None, None, None), context=context_id)):
+        if self._has_context(context_id):
             logger.debug("Using context <%s>" % context_id)
             return self.graph.get_context(context_id)
 
-        cache_path = os.path.join(self.cachedir, urllib2.quote(url, safe="")) + '.ttl'
-        if os.path.exists(cache_path):
-            logger.debug("Load local copy of <%s> from '%s'", context_id, cache_path)
-            return self.graph.parse(cache_path, format='turtle', publicID=context_id)
+        cache_path = self._get_cache_path(url)
+        binary_path = cache_path + '.rdfb'
+        turtle_path = cache_path + '.ttl'
+        if os.path.exists(binary_path):
+            logger.debug("Load local copy of <%s> from '%s'", context_id, binary_path)
+            graph = self.replace_context(context_id, read_triples(binary_path))
+        elif os.path.exists(turtle_path):
+            logger.debug("Load local copy of <%s> from '%s'", context_id, turtle_path)
+            graph = self.graph.parse(turtle_path, format='turtle', publicID=context_id)
+            write_triples(graph, binary_path)
         else:
-            logger.debug("Fetching <%s> to '%s'", context_id, cache_path)
+            logger.debug("Fetching <%s> to '%s'", context_id, binary_path)
             graph = self.graph.parse(url,
                     format='rdfa' if url.endswith('html') else None)
-            with open(cache_path, 'w') as f:
-                graph.serialize(f, format='turtle')
-            return graph
+            write_triples(graph, binary_path)
+            if self.turtle_sidecar:
+                with open(turtle_path, 'w') as f:
+                    graph.serialize(f, format='turtle')
+        self._commit()
+        return graph
+
+    def load_many(self, urls, processes=None):
+        """
+        Load several sources. Changed local files and uncached remote sources
+        are first parsed in parallel worker processes, which leave binary
+        copies for `load` to read.
+        """
+        jobs = []
+        for url in urls:
+            cache_path = self._get_cache_path(url)
+            if os.path.isfile(url):
+                if self._is_changed(url) and not _is_newer(cache_path + '.rdfb', url):
+                    jobs.append((url, cache_path + '.rdfb', None))
+            elif not self._has_context(url) and not any(
+                    os.path.exists(cache_path + suffix) for suffix in ('.rdfb', '.ttl')):
+                jobs.append((url, cache_path + '.rdfb',
+                             cache_path + '.ttl' if self.turtle_sidecar else None))
+        if len(jobs) > 1:
+            pool = Pool(min(processes or cpu_count(), len(jobs)))
+            try:
+                pool.map(_parse_to_file, jobs)
+            finally:
+                pool.close()
+                pool.join()
+        return [self.load(url) for url in urls]
+
+    def replace_context(self, context_id, triples):
+        """
+        Replace all triples in the named graph context_id with the given ones.
+        """
+        context = self.graph.get_context(context_id)
+        self.graph.remove_context(context)
+        self.graph.addN((s, p, o, context) for s, p, o in triples)
+        return context
+
+    def _is_changed(self, url):
+        last_vocab_mtime = self.mtime_map.get(url)
+        return not last_vocab_mtime or last_vocab_mtime < os.stat(url).st_mtime
+
+    def _has_context(self, context_id):
+        return any(self.graph.triples((None, None, None), context=context_id))
+
+    def _get_cache_path(self, url):
+        return os.path.join(self.cachedir, urllib2.quote(url, safe=""))
+
+    def _commit(self):
+        if not self.persistent:
+            return
+        # Commit the store before the mtimes, so that a failure in between
+        # only causes a reparse.
+        self.graph.commit()
+        mtime_map_path = os.path.join(self.cachedir, self.MTIME_MAP_FILE)
+        with open(mtime_map_path + '.tmp', 'w') as f:
+            json.dump(self.mtime_map, f)
+        os.rename(mtime_map_path + '.tmp', mtime_map_path)
+
+    def _load_mtime_map(self):
+        mtime_map_path = os.path.join(self.cachedir, self.MTIME_MAP_FILE)
+        if not os.path.exists(mtime_map_path):
+            return {}
+        with open(mtime_map_path) as f:
+            return json.load(f)
+
+
+def _parse(url):
+    # use CG as workaround for json-ld always loading as dataset
+    graph = ConjunctiveGraph()
+    if os.path.isfile(url):
+        graph.parse(url, format=guess_format(url))
+    else:
+        graph.parse(url, format='rdfa' if url.endswith('html') else None)
+    return graph
+
+
+def _parse_to_file(job):
+    url, binary_path, turtle_path = job
+    graph = _parse(url)
+    write_triples(graph, binary_path)
+    if turtle_path:
+        with open(turtle_path, 'w') as f:
+            graph.serialize(f, format='turtle')
+
+
+def _is_newer(path, other_path):
+    return (os.path.exists(path) and
+            os.stat(path).st_mtime >= os.stat(other_path).st_mtime)
@@ -0,0 +1,278 @@
+# -*- coding: UTF-8 -*-
+from __future__ import unicode_literals, print_function
+__metaclass__ = type
+
+from array import array
+from itertools import groupby
+import json
+import os
+import sqlite3
+import struct
+import sys
+
+from rdflib import BNode, Graph, Literal, URIRef
+from rdflib.store import Store, VALID_STORE
+
+
+MAGIC = b'LXLGRAPH'
+FORMAT_VERSION = 1
+HEADER = struct.Struct(str('<8sIII'))
+
+
+class SQLiteStore(Store):
+    """
+    A persistent, context aware rdflib store in an SQLite database. Triples
+    are queried through indexes, without loading the database into memory.
+
+    Changes are made in a transaction, which is written by `commit` (or by
+    `close(commit_pending_transaction=True)`).
+
+    >>> from rdflib import ConjunctiveGraph
+    >>> graph = ConjunctiveGraph(SQLiteStore(':memory:'))
+    >>> ctx = URIRef('http://example.org/ctx')
+    >>> graph.add((URIRef('http://example.org/a'), URIRef('http://example.org/p'),
+    ...            Literal('A', lang='en'), ctx))
+    >>> print(graph.value(URIRef('http://example.org/a'),
+    ...                   URIRef('http://example.org/p')).n3())
+    "A"@en
+    >>> len(graph.get_context(ctx))
+    1
+    >>> graph.remove_context(ctx)
+    >>> len(graph)
+    0
+    """
+
+    context_aware = True
+    formula_aware = False
+    transaction_aware = True
+    graph_aware = False
+
+    def __init__(self, configuration=None, identifier=None):
+        super(SQLiteStore, self).__init__(configuration)
+        self.identifier = identifier
+        self._db = None
+        if configuration:
+            self.open(configuration)
+
+    def open(self, configuration, create=True):
+        self._db = sqlite3.connect(configuration, check_same_thread=False)
+        if create:
+            self._db.executescript("""
+                CREATE TABLE IF NOT EXISTS quads (
+                    s TEXT NOT NULL, p TEXT NOT NULL, o TEXT NOT NULL,
+                    c TEXT NOT NULL, PRIMARY KEY (s, p, o, c));
+                CREATE INDEX IF NOT EXISTS quads_pos ON quads (p, o);
+                CREATE INDEX IF NOT EXISTS quads_os ON quads (o, s);
+                CREATE INDEX IF NOT EXISTS quads_c ON quads (c);
+                CREATE TABLE IF NOT EXISTS namespaces (
+                    prefix TEXT PRIMARY KEY, namespace TEXT UNIQUE);
+            """)
+        return VALID_STORE
+
+    def close(self, commit_pending_transaction=False):
+        if self._db is None:
+            return
+        if commit_pending_transaction:
+            self._db.commit()
+        self._db.close()
+        self._db = None
+
+    def commit(self):
+        self._db.commit()
+
+    def rollback(self):
+        self._db.rollback()
+
+    def add(self, triple, context, quoted=False):
+        self._db.execute("INSERT OR IGNORE INTO quads VALUES (?, ?, ?, ?)",
+                         _to_keys(triple) + (_context_key(context),))
+
+    def addN(self, quads):
+        self._db.executemany("INSERT OR IGNORE INTO quads VALUES (?, ?, ?, ?)",
+                             (_to_keys((s, p, o)) + (_context_key(c),)
+                              for s, p, o, c in quads))
+
+    def remove(self, triple, context=None):
+        where, params = _where(triple, context)
+        self._db.execute("DELETE FROM quads" + where, params)
+
+    def triples(self, triple, context=None):
+        where, params = _where(triple, context)
+        if context is not None:
+            contexts = [context]
+            rows = self._db.execute("SELECT s, p, o FROM quads" + where, params)
+            for row in rows:
+                yield _from_keys(row), iter(contexts)
+            return
+        rows = self._db.execute(
+                "SELECT s, p, o, c FROM quads" + where + " ORDER BY s, p, o",
+                params)
+        for spo, group in groupby(rows, lambda row: row[:3]):
+            yield _from_keys(spo), (self._get_context(row[3]) for row in group)
+
+    def __len__(self, context=None):
+        if context is not None:
+            row = self._db.execute("SELECT COUNT(*) FROM quads WHERE c = ?",
+                                   (_context_key(context),)).fetchone()
+        else:
+            row = self._db.execute(
+                    "SELECT COUNT(*) FROM (SELECT DISTINCT s, p, o FROM quads)"
+                    ).fetchone()
+        return row[0]
+
+    def contexts(self, triple=None):
+        if triple is None:
+            rows = self._db.execute("SELECT DISTINCT c FROM quads")
+        else:
+            where, params = _where(triple, None)
+            rows = self._db.execute("SELECT c FROM quads" + where, params)
+        for c, in rows.fetchall():
+            yield self._get_context(c)
+
+    def bind(self, prefix, namespace):
+        self._db.execute("DELETE FROM namespaces WHERE namespace = ?",
+                         (namespace,))
+        self._db.execute("INSERT OR REPLACE INTO namespaces VALUES (?, ?)",
+                         (prefix, namespace))
+
+    def namespace(self, prefix):
+        row = self._db.execute(
+                "SELECT namespace FROM namespaces WHERE prefix = ?",
+                (prefix,)).fetchone()
+        return URIRef(row[0]) if row else None
+
+    def prefix(self, namespace):
+        row = self._db.execute(
+                "SELECT prefix FROM namespaces WHERE namespace = ?",
+                (namespace,)).fetchone()
+        return row[0] if row else None
+
+    def namespaces(self):
+        for prefix, namespace in self._db.execute(
+                "SELECT prefix, namespace FROM namespaces").fetchall():
+            yield prefix, URIRef(namespace)
+
+    def _get_context(self, key):
+        return Graph(store=self, identifier=_from_key(key))
+
+
+def write_triples(triples, path):
+    """
+    Write triples to path in a compact binary format: a table of distinct
+    terms followed by an array of term numbers, three per triple. The file
+    is written atomically.
+    """
+    term_numbers = {}
+    numbers = array(str('I'))
+    for triple in triples:
+        for term in triple:
+            number = term_numbers.get(term)
+            if number is None:
+                number = term_numbers[term] = len(term_numbers)
+            numbers.append(number)
+    terms = [None] * len(term_numbers)
+    for term, number in term_numbers.items():
+        terms[number] = term
+    # NOTE: keys contain no newlines, since literals are stored as JSON
+    term_data = '\n'.join(_to_key(term) for term in terms).encode('utf-8')
+    if sys.byteorder != 'little':
+        numbers.byteswap()
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(terms), len(numbers) // 3))
+        f.write(term_data)
+        f.write(_tobytes(numbers))
+    os.rename(tmp_path, path)
+
+
+def read_triples(path):
+    """
+    Read triples written by `write_triples`.
+
+    >>> import tempfile, shutil
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> triples = [(URIRef('http://example.org/a'), URIRef('http://example.org/p'),
+    ...             Literal('A\\nB', lang='en')),
+    ...            (URIRef('http://example.org/a'), URIRef('http://example.org/p'),
+    ...             BNode('b0'))]
+    >>> write_triples(triples, os.path.join(tmpdir, 'graph.bin'))
+    >>> list(read_triples(os.path.join(tmpdir, 'graph.bin'))) == triples
+    True
+    >>> shutil.rmtree(tmpdir)
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, version, term_count, triple_count = HEADER.unpack_from(data)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise ValueError("Unsupported graph file: %s" % path)
+    numbers = array(str('I'))
+    numbers_start = len(data) - triple_count * 3 * numbers.itemsize
+    _frombytes(numbers, data[numbers_start:])
+    if sys.byteorder != 'little':
+        numbers.byteswap()
+    term_data = data[HEADER.size:numbers_start].decode('utf-8')
+    terms = [_from_key(key) for key in term_data.split('\n')] if term_count else []
+    for i in range(0, len(numbers), 3):
+        yield terms[numbers[i]], terms[numbers[i + 1]], terms[numbers[i + 2]]
+
+
+def _tobytes(numbers):
+    return numbers.tobytes() if hasattr(numbers, 'tobytes') else numbers.tostring()
+
+
+def _frombytes(numbers, data):
+    if hasattr(numbers, 'frombytes'):
+        numbers.frombytes(data)
+    else:
+        numbers.fromstring(data)
+
+
+def _where(triple, context):
+    clauses, params = [], []
+    for column, term in zip('spo', triple):
+        if term is not None:
+            clauses.append(column + " = ?")
+            params.append(_to_key(term))
+    if context is not None:
+        clauses.append("c = ?")
+        params.append(_context_key(context))
+    return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+
+def _to_keys(triple):
+    return tuple(_to_key(term) for term in triple)
+
+
+def _from_keys(keys):
+    return tuple(_from_key(key) for key in keys)
+
+
+def _context_key(context):
+    return _to_key(getattr(context, 'identifier', context))
+
+
+def _to_key(term):
+    """
+    >>> for term in [URIRef('http://example.org/'), BNode('b0'),
+    ...              Literal('1', datatype=URIRef('http://example.org/int'))]:
+    ...     print(_to_key(term), _from_key(_to_key(term)) == term)
+    <http://example.org/ True
+    _b0 True
+    "["1", null, "http://example.org/int"] True
+    """
+    if isinstance(term, Literal):
+        return '"' + json.dumps([term, term.language, term.datatype])
+    elif isinstance(term, BNode):
+        return '_%s' % term
+    return '<%s' % term
+
+
+def _from_key(key):
+    kind, value = key[0], key[1:]
+    if kind == '"':
+        value, lang, datatype = json.loads(value)
+        return Literal(value, lang=lang,
+                       datatype=URIRef(datatype) if datatype else None)
+    elif kind == '_':
+        return BNode(value)
+    return URIRef(value)
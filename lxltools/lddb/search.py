@@ -0,0 +1,415 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+__metaclass__ = type
+if bytes is not str:
+    unicode = str
+
+from bisect import bisect_left, insort
+from fnmatch import fnmatch
+from itertools import islice
+from threading import RLock
+import logging
+import math
+import re
+import time
+
+from ..ld.keys import GRAPH, ID, TYPE
+
+
+logger = logging.getLogger(__name__)
+
+
+EXACT_FIELDS = (ID, TYPE)
+
+
+class EmbeddedSearch:
+    """
+    An in-process inverted index over the entries of stored records,
+    answering the subset of the Elasticsearch search API used by DataView:
+
+    - bool queries with `must` (`query_string`, `match`), `filter` and
+      `should` (`prefix`, with `minimum_should_match`),
+    - nested `terms` aggregations,
+    - `from`, `size`, `sort`, `search_after` and `_source` filtering.
+
+    It can be used in place of an Elasticsearch client for development and
+    small single-node deployments. Build it with `from_storage` and keep it
+    current with `update_from`.
+    """
+
+    def __init__(self, get_document=None):
+        self.get_document = get_document or get_entry
+        self.docs = {}
+        self.doc_fields = {}
+        self.doc_keys = {}
+        self.postings = {}
+        # Sorted string terms by (kind, field) of posting keys, for prefixes
+        self.terms = {}
+        self.record_docs = {}
+        self.last_change = None
+        self.generation = 0
+        self.indices = _Indices(self)
+        self._lock = RLock()
+
+    @classmethod
+    def from_storage(cls, storage, **kws):
+        index = cls(**kws)
+        index.update_from(storage)
+        return index
+
+    def update_from(self, storage, batch_size=1000):
+        """
+        Apply all changes made in storage since the last update.
+        """
+        while True:
+            changes = storage.find_changes(self.last_change, limit=batch_size)
+            for record, deleted in changes:
+                if deleted:
+                    self.remove_record(record.identifier)
+                else:
+                    self.index_record(record)
+                self.last_change = (record.modified, record.identifier)
+            if len(changes) < batch_size:
+                break
+
+    def index_record(self, record):
+        doc = self.get_document(record.data)
+        doc_id = doc.get(ID) if doc else None
+        if not doc_id:
+            return
+        with self._lock:
+            self.remove_record(record.identifier)
+            self.record_docs[record.identifier] = doc_id
+            self.add(doc_id, doc)
+
+    def remove_record(self, identifier):
+        with self._lock:
+            doc_id = self.record_docs.pop(identifier, None)
+            if doc_id:
+                self.remove(doc_id)
+
+    def add(self, doc_id, source):
+        with self._lock:
+            self.remove(doc_id)
+            fields = {}
+            for field, value in _iter_fields(source):
+                fields.setdefault(field, []).append(value)
+            keys = set()
+            for field, values in fields.items():
+                for value in values:
+                    keys.add(('=', field, value))
+                    if isinstance(value, unicode) and field not in EXACT_FIELDS:
+                        for token in tokenize(value):
+                            keys.add(('~', field, token))
+                            keys.add(('~', None, token))
+            for key in keys:
+                doc_ids = self.postings.get(key)
+                if doc_ids is None:
+                    doc_ids = self.postings[key] = set()
+                    self._add_term(key)
+                doc_ids.add(doc_id)
+            self.docs[doc_id] = source
+            self.doc_fields[doc_id] = fields
+            self.doc_keys[doc_id] = keys
+            self.generation += 1
+
+    def remove(self, doc_id):
+        with self._lock:
+            if doc_id not in self.docs:
+                return
+            for key in self.doc_keys.pop(doc_id):
+                ids = self.postings[key]
+                ids.discard(doc_id)
+                if not ids:
+                    del self.postings[key]
+                    self._remove_term(key)
+            del self.docs[doc_id]
+            del self.doc_fields[doc_id]
+            self.generation += 1
+
+    def search(self, body=None, size=None, from_=None, index=None, **kws):
+        start = time.time()
+        body = body or {}
+        size = body.get('size', 10) if size is None else size
+        from_ = body.get('from', 0) if from_ is None else from_
+
+        with self._lock:
+            scores = self._query(body.get('query') or {'match_all': {}})
+            sort = body.get('sort')
+            ranked = self._sort(scores, sort)
+            after = body.get('search_after')
+            if after:
+                ranked = [hit for hit in ranked
+                          if _compare(hit[1], after, sort) > 0]
+
+            hits = []
+            for doc_id, sort_values in ranked[from_:from_ + size]:
+                hit = {
+                    '_id': doc_id,
+                    '_score': scores[doc_id],
+                    '_source': _filter_source(self.docs[doc_id],
+                                              body.get('_source', True))
+                }
+                if sort:
+                    hit['sort'] = sort_values
+                hits.append(hit)
+
+            results = {
+                'hits': {
+                    'total': len(scores),
+                    'max_score': max(scores.values()) if scores else None,
+                    'hits': hits
+                }
+            }
+            if body.get('aggs'):
+                results['aggregations'] = self._aggregate(body['aggs'], scores)
+
+        results['took'] = int((time.time() - start) * 1000)
+        return results
+
+    def _query(self, query):
+        """
+        Get a map from matching doc ids to scores.
+        """
+        (qtype, q), = query.items()
+        if qtype == 'match_all':
+            return dict.fromkeys(self.docs, 1.0)
+        elif qtype == 'bool':
+            return self._bool(q)
+        elif qtype == 'query_string':
+            return self._query_string(q['query'])
+        elif qtype == 'match':
+            (field, value), = q.items()
+            if isinstance(value, dict):
+                value = value['query']
+            return self._match(field, value)
+        elif qtype == 'term':
+            (field, value), = q.items()
+            return dict.fromkeys(self.postings.get(('=', field, value), ()), 1.0)
+        elif qtype == 'prefix':
+            (field, value), = q.items()
+            if isinstance(value, dict):
+                value = value['value']
+            return self._prefix(field, value)
+        raise ValueError("Unsupported query type: %s" % qtype)
+
+    def _bool(self, q):
+        scores = None
+        for clause in _listed(q.get('must')) + _listed(q.get('filter')):
+            matches = self._query(clause)
+            if scores is None:
+                scores = matches
+            else:
+                scores = {doc_id: score + matches[doc_id]
+                          for doc_id, score in scores.items()
+                          if doc_id in matches}
+
+        shoulds = _listed(q.get('should'))
+        if shoulds:
+            min_match = q.get('minimum_should_match',
+                              0 if scores is not None else 1)
+            counts = {}
+            should_scores = {}
+            for clause in shoulds:
+                for doc_id, score in self._query(clause).items():
+                    counts[doc_id] = counts.get(doc_id, 0) + 1
+                    should_scores[doc_id] = should_scores.get(doc_id, 0) + score
+            if scores is None:
+                scores = dict.fromkeys(self.docs, 0.0)
+            scores = {doc_id: score + should_scores.get(doc_id, 0)
+                      for doc_id, score in scores.items()
+                      if counts.get(doc_id, 0) >= min_match}
+
+        if scores is None:
+            scores = dict.fromkeys(self.docs, 1.0)
+
+        for clause in _listed(q.get('must_not')):
+            for doc_id in self._query(clause):
+                scores.pop(doc_id, None)
+
+        return scores
+
+    def _query_string(self, query):
+        if query.strip() in ('', '*'):
+            return dict.fromkeys(self.docs, 1.0)
+        scores = {}
+        for word in query.lower().split():
+            if word.endswith('*'):
+                prefixes = tokenize(word[:-1])
+                if not prefixes:
+                    continue
+                tokens = list(self._iter_prefixed('~', None, prefixes[0]))
+            else:
+                tokens = tokenize(word)
+            for token in tokens:
+                self._add_token_scores(scores, ('~', None, token))
+        return scores
+
+    def _match(self, field, value):
+        scores = {}
+        for doc_id in self.postings.get(('=', field, value), ()):
+            scores[doc_id] = 1.0
+        if isinstance(value, unicode) and field not in EXACT_FIELDS:
+            for token in tokenize(value):
+                self._add_token_scores(scores, ('~', field, token))
+        return scores
+
+    def _prefix(self, field, value):
+        return {doc_id: 1.0
+                for term in self._iter_prefixed('=', field, value)
+                for doc_id in self.postings[('=', field, term)]}
+
+    def _iter_prefixed(self, kind, field, prefix):
+        terms = self.terms.get((kind, field), ())
+        for term in islice(terms, bisect_left(terms, prefix), None):
+            if not term.startswith(prefix):
+                break
+            yield term
+
+    def _add_term(self, key):
+        kind, field, value = key
+        if isinstance(value, unicode):
+            insort(self.terms.setdefault((kind, field), []), value)
+
+    def _remove_term(self, key):
+        kind, field, value = key
+        terms = self.terms.get((kind, field))
+        if terms and isinstance(value, unicode):
+            i = bisect_left(terms, value)
+            if i < len(terms) and terms[i] == value:
+                del terms[i]
+
+    def _add_token_scores(self, scores, key):
+        doc_ids = self.postings.get(key)
+        if not doc_ids:
+            return
+        idf = math.log(1 + float(len(self.docs)) / len(doc_ids))
+        for doc_id in doc_ids:
+            scores[doc_id] = scores.get(doc_id, 0) + idf
+
+    def _sort(self, scores, sort):
+        if not sort:
+            return sorted(((doc_id, None) for doc_id in scores),
+                          key=lambda hit: (-scores[hit[0]], hit[0]))
+        hits = [(doc_id, [self._sort_value(doc_id, scores, field)
+                          for field, order in _sort_spec(sort)])
+                for doc_id in scores]
+        for i, (field, order) in reversed(list(enumerate(_sort_spec(sort)))):
+            hits.sort(key=lambda hit: hit[1][i], reverse=order == 'desc')
+        return hits
+
+    def _sort_value(self, doc_id, scores, field):
+        if field == '_score':
+            return scores[doc_id]
+        if field == '_id':
+            return doc_id
+        values = self.doc_fields[doc_id].get(field)
+        return min(values) if values else ''
+
+    def _aggregate(self, aggs, doc_ids):
+        results = {}
+        for name, agg in aggs.items():
+            terms = agg['terms']
+            field = terms['field']
+            counts = {}
+            for doc_id in doc_ids:
+                for value in set(self.doc_fields[doc_id].get(field, ())):
+                    counts.setdefault(value, []).append(doc_id)
+            buckets = []
+            for value, ids in sorted(counts.items(),
+                    key=lambda kv: (-len(kv[1]), kv[0]))[:terms.get('size', 10)]:
+                bucket = {'key': value, 'doc_count': len(ids)}
+                if agg.get('aggs'):
+                    bucket.update(self._aggregate(agg['aggs'], ids))
+                buckets.append(bucket)
+            results[name] = {'buckets': buckets}
+        return results
+
+
+class _Indices:
+
+    def __init__(self, search):
+        self.search = search
+
+    def stats(self, index=None, metric=None):
+        indexing = {'index_total': self.search.generation, 'delete_total': 0}
+        return {'_all': {'primaries': {
+            'docs': {'count': len(self.search.docs)},
+            'indexing': indexing}}}
+
+
+def get_entry(data):
+    if 'descriptions' in data:
+        return data['descriptions']['entry']
+    elif GRAPH in data:
+        for item in data[GRAPH]:
+            if GRAPH not in item:
+                return item
+    else:
+        return data
+
+
+def tokenize(text):
+    """
+    >>> print(" ".join(tokenize("One, Any (1911-)")))
+    one any 1911
+    """
+    return re.findall(r'\w+', text.lower(), flags=re.UNICODE)
+
+
+def _iter_fields(node, prefix=''):
+    for key, values in node.items():
+        path = prefix + key
+        if not isinstance(values, list):
+            values = [values]
+        for value in values:
+            if isinstance(value, dict):
+                for field_value in _iter_fields(value, path + '.'):
+                    yield field_value
+            elif value is not None:
+                yield path, value
+
+
+def _listed(clauses):
+    if clauses is None:
+        return []
+    return clauses if isinstance(clauses, list) else [clauses]
+
+
+def _sort_spec(sort):
+    for spec in _listed(sort):
+        if isinstance(spec, dict):
+            (field, order), = spec.items()
+            if isinstance(order, dict):
+                order = order.get('order', 'asc')
+        else:
+            field = spec
+            order = 'desc' if spec == '_score' else 'asc'
+        yield field, order
+
+
+def _compare(values, cursor, sort):
+    """
+    >>> sort = [{'_score': 'desc'}, {'@id': 'asc'}]
+    >>> _compare([1.0, '/b'], [1.0, '/a'], sort)
+    1
+    >>> _compare([2.0, '/b'], [1.0, '/a'], sort)
+    -1
+    """
+    for value, after, (field, order) in zip(values, cursor, _sort_spec(sort)):
+        if value != after:
+            greater = value > after
+            return 1 if greater == (order == 'asc') else -1
+    return 0
+
+
+def _filter_source(source, includes):
+    if includes is True:
+        return source
+    if includes is False:
+        return {}
+    if isinstance(includes, dict):
+        includes = includes.get('includes', ['*'])
+    includes = _listed(includes)
+    return {key: value for key, value in source.items()
+            if any(fnmatch(key, pattern) for pattern in includes)}
@@ -2,14 +2,19 @@
 from __future__ import unicode_literals
 
 import logging
+import os
 from os import path as P
 from datetime import datetime
 import hashlib
+import itertools
 import json
+import threading
 from collections import namedtuple
 
 import psycopg2
 
+from ..tracing import default_tracer, traced
+
 
 logger = logging.getLogger(__name__)
 
@@ -17,27 +22,66 @@ logger = logging.getLogger(__name__)
 class Storage:
 
     def __init__(self, base_table='lddb', database=None, host=None, user=None, password=None,
-            get_connection=None):
-        self._connection = None
+            get_connection=None, tracer=None):
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self.tracer = tracer or default_tracer
         self.get_gonnection = get_connection or (
                 lambda: psycopg2.connect(database=database, host=host,
                         user=user, password=password))
         self.tname = base_table
         self.vtname = "{0}__versions".format(base_table)
         self.versioning = True
+        self._cursor_ids = itertools.count(1)
 
     @property
     def connection(self):
-        if not self._connection or self._connection.closed:
-            self._connection = self.get_gonnection()
-        return self._connection
+        """
+        The connection of the current thread, so that threads (e.g. of the
+        DataView pool) run their queries concurrently. A forked process gets
+        new connections.
+        """
+        connection = getattr(self._local, 'connection', None)
+        pid = os.getpid()
+        if not connection or connection.closed or self._local.pid != pid:
+            connection = self._local.connection = self.get_gonnection()
+            self._local.pid = pid
+            with self._lock:
+                self._connections = [(cpid, conn) for cpid, conn in self._connections
+                                     if not conn.closed] + [(pid, connection)]
+        return connection
+
+    def release_connection(self):
+        """
+        Close the connection of the current thread, e.g. before it exits.
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            return
+        self._local.connection = None
+        with self._lock:
+            self._connections = [(cpid, conn) for cpid, conn in self._connections
+                                 if conn is not connection]
+        if not connection.closed:
+            connection.close()
 
     def disconnect(self):
-        if self._connection:
-            self._connection.close()
+        """
+        Close the connections opened by all threads of this process.
+        """
+        pid = os.getpid()
+        with self._lock:
+            connections = [conn for cpid, conn in self._connections if cpid == pid]
+            self._connections = [(cpid, conn) for cpid, conn in self._connections
+                                 if cpid != pid]
+        for connection in connections:
+            if not connection.closed:
+                connection.close()
 
     # Load-methods
 
+    @traced('storage.get_record')
     def get_record(self, identifier):# -> Record
         sql = """
             SELECT id, data, created, modified FROM {0}
@@ -51,6 +95,7 @@ class Storage:
             return self._inject_storage_data(result)
         return None
 
+    @traced('storage.find_record_ids')
     def find_record_ids(self, identifier):
         """
         Get the record ids containing a description of the given identifier.
@@ -72,7 +117,9 @@ class Storage:
         for rec_id, in cursor:
             yield rec_id
 
-    def find_by_relation(self, rel, ref, limit=None, offset=None):
+    @traced('storage.find_by_relation')
+    def find_by_relation(self, rel, ref, limit=None, offset=None,
+            stream=False):
         ref_query = '{"%s": {"@id": "%s"}}' % (rel, ref)
         refs_query = '{"%s": [{"@id": "%s"}]}' % (rel, ref)
         where = """
@@ -81,21 +128,56 @@ class Storage:
             """
         keys = {'set_ref_query': '[%s]' % ref_query,
                 'set_refs_query': '[%s]' % refs_query}
-        return self._do_find(where, keys, limit, offset)
+        return self._do_find(where, keys, limit, offset, stream)
 
-    def find_by_quotation(self, identifier, limit=None, offset=None):
+    @traced('storage.find_by_quotation')
+    def find_by_quotation(self, identifier, limit=None, offset=None,
+            stream=False):
         """
-        Find records that reference the given identifier by quotation.
+        Find records that reference the given identifier, or any of a list of
+        identifiers, by quotation.
         """
-        where = """
-            data->'@graph' @> %(ref_query)s
-            OR data->'@graph' @> %(sameas_query)s
-            """
-        keys = {'ref_query': '[{"@graph": {"@id": "%s"}}]' % identifier,
-                'sameas_query': '[{"@graph": {"sameAs": [{"@id": "%s"}]}}]' % identifier}
-        return self._do_find(where, keys, limit, offset)
+        identifiers = identifier if isinstance(identifier, list) else [identifier]
+        clauses = []
+        keys = {}
+        for i, identifier in enumerate(identifiers):
+            clauses.append("""
+                data->'@graph' @> %(ref_query_{0})s
+                OR data->'@graph' @> %(sameas_query_{0})s
+                """.format(i))
+            keys['ref_query_%d' % i] = '[{"@graph": {"@id": "%s"}}]' % identifier
+            keys['sameas_query_%d' % i] = '[{"@graph": {"sameAs": [{"@id": "%s"}]}}]' % identifier
+        where = " OR ".join(clauses)
+        return self._do_find(where, keys, limit, offset, stream)
 
-    def find_by_value(self, p, value, limit=None, offset=None):
+    @traced('storage.count_quotations')
+    def count_quotations(self, identifiers):
+        """
+        Count the records quoting each of the given identifiers, by id or by
+        sameAs (as matched by `find_by_quotation`).
+        """
+        if not identifiers:
+            return {}
+        sql = """
+            SELECT ref.identifier, (
+                SELECT count(*) FROM {0}
+                WHERE data->'@graph' @> ('[{{"@graph": {{"@id": "'
+                                         || ref.identifier || '"}}}}]')::jsonb
+                OR data->'@graph' @> ('[{{"@graph": {{"sameAs": [{{"@id": "'
+                                      || ref.identifier || '"}}]}}}}]')::jsonb
+            ) FROM unnest(%(identifiers)s::text[]) AS ref(identifier)
+            """.format(self.tname)
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(sql, {'identifiers': list(identifiers)})
+            result = dict(cursor)
+        finally:
+            self.connection.commit()
+        return result
+
+    @traced('storage.find_by_value')
+    def find_by_value(self, p, value, limit=None, offset=None,
+            stream=False):
         value_query = '{"%s": "%s"}' % (p, value)
         values_query = '{"%s": ["%s"]}' % (p, value)
         where = """
@@ -104,31 +186,37 @@ class Storage:
             """
         keys = {'set_value_query': '[%s]' % value_query,
                 'set_values_query': '[%s]' % values_query}
-        return self._do_find(where, keys, limit, offset)
+        return self._do_find(where, keys, limit, offset, stream)
 
-    def find_by_example(self, example, limit=None, offset=None):
+    @traced('storage.find_by_example')
+    def find_by_example(self, example, limit=None, offset=None,
+            stream=False):
         value_query = json.dumps(example, ensure_ascii=False, sort_keys=True)
         where = """
             data->'@graph' @> %(set_value_query)s
             """
         keys = {'set_value_query': '[%s]' % value_query}
-        return self._do_find(where, keys, limit, offset)
+        return self._do_find(where, keys, limit, offset, stream)
 
-    def find_by_query(self, p, q, limit=None, offset=None):
+    @traced('storage.find_by_query')
+    def find_by_query(self, p, q, limit=None, offset=None,
+            stream=False):
         # NOTE: ILIKE is *really* slow, if we keep this, index expected property queries
         where = """
             data->'descriptions'->'entry'->>%(p)s ILIKE %(q)s
             """
         keys = {'p': p, 'q': '%'+ q +'%'}
-        return self._do_find(where, keys, limit, offset)
+        return self._do_find(where, keys, limit, offset, stream)
 
-    def _do_find(self, where, keys, limit, offset):
+    def _do_find(self, where, keys, limit, offset, stream=False):
         offset = offset or 0
         sql = """
             SELECT id, data, created, modified FROM {tname}
             WHERE {where}
             LIMIT {limit} OFFSET {offset}
         """.format(tname=self.tname, where=where, limit=limit, offset=offset)
+        if stream:
+            return self._iter_find(sql, keys)
         cursor = self.connection.cursor()
         try:
             cursor.execute(sql, keys)
@@ -137,6 +225,72 @@ class Storage:
             self.connection.commit()
         return result
 
+    @traced('storage.find_changes')
+    def find_changes(self, since=None, limit=None):
+        """
+        Get (record, deleted) pairs for records changed after since, in order
+        of modification and id. Give the (modified, id) of the last record read
+        as since to page through changes (records written in one transaction
+        share their modification time), or a modification time to start from.
+        """
+        if isinstance(since, tuple):
+            where = "WHERE (modified, id) > (%(modified)s, %(id)s)"
+            keys = {'modified': since[0], 'id': since[1]}
+        else:
+            where = "WHERE modified > %(modified)s" if since else ""
+            keys = {'modified': since}
+        sql = """
+            SELECT id, data, created, modified, deleted FROM {0}
+            {1}
+            ORDER BY modified ASC, id ASC
+            {2}
+            """.format(self.tname, where,
+                    "LIMIT %d" % limit if limit else "")
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(sql, keys)
+            result = [(self._inject_storage_data(row[:4]), row[4])
+                      for row in cursor]
+        finally:
+            self.connection.commit()
+        return result
+
+    @traced('storage.get_last_change')
+    def get_last_change(self):
+        """
+        Get the (modified, id) of the last changed record, for reading changes
+        made after it with `find_changes`. Returns None if there are no records.
+        """
+        sql = """
+            SELECT modified, id FROM {0}
+            ORDER BY modified DESC, id DESC
+            LIMIT 1
+            """.format(self.tname)
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(sql)
+            result = cursor.fetchone()
+        finally:
+            self.connection.commit()
+        return (result[0].isoformat(), result[1]) if result else None
+
+    def _iter_find(self, sql, keys, itersize=100):
+        """
+        Generate records read through a server-side cursor, a batch at a time.
+        """
+        connection = self.connection
+        cursor = connection.cursor(name='lddb_find_%d' % next(self._cursor_ids),
+                withhold=True)
+        cursor.itersize = itersize
+        try:
+            cursor.execute(sql, keys)
+            for record in self._assemble_result_list(cursor):
+                yield record
+        finally:
+            cursor.close()
+            connection.commit()
+
+    @traced('storage.get_all_versions')
     def get_all_versions(self, identifier):
         cursor = self.connection.cursor()
         if self.versioning:
@@ -159,12 +313,13 @@ class Storage:
         (identifier, data, created, modified) = result
         created = created.isoformat()
         modified = modified.isoformat()
-        return Record(identifier, data)
+        return Record(identifier, data, created, modified)
 
     def _assemble_result_list(self, results):
         for result in results:
             yield self._inject_storage_data(result)
 
+    @traced('storage.get_record_status')
     def get_record_status(self, identifier):
         cursor = self.connection.cursor()
         sql = """
@@ -184,4 +339,4 @@ class Storage:
         return {'exists': False}
 
 
-Record = namedtuple('Record', 'identifier, data')
+Record = namedtuple('Record', 'identifier, data, created, modified')
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 from __future__ import unicode_literals, print_function
 
+from operator import mul
 from zlib import crc32
 import string
 import time
@@ -42,6 +43,108 @@ def librisencode(a, b):
     return  timepart + codepart
 
 
+CODE_WIDTH = 7
+
+_SIZE = len(lower_consonants_numbers)
+_GROUP = _SIZE ** 3
+_MAX_CODE = _SIZE ** CODE_WIDTH
+# All three digit numbers, zero padded, in lower_consonants_numbers
+_DIGIT_GROUPS = [a + b + c for a in lower_consonants_numbers
+                 for b in lower_consonants_numbers
+                 for c in lower_consonants_numbers]
+# Translation tables, by rotation, for caesarize and its inverse
+_ROTATIONS = [{ord(c): lower_consonants_numbers[(i + r) % _SIZE]
+               for i, c in enumerate(lower_consonants_numbers)}
+              for r in range(_SIZE)]
+_UNROTATIONS = [{ord(c): lower_consonants_numbers[(i - r) % _SIZE]
+                 for i, c in enumerate(lower_consonants_numbers)}
+                for r in range(_SIZE)]
+# From lower_consonants_numbers to the digits int accepts in base 30
+_INT_DIGITS = {ord(c): "0123456789abcdefghijklmnopqrst"[i]
+               for i, c in enumerate(lower_consonants_numbers)}
+_SQUARES = []
+
+
+def librisencode_many(pairs):
+    """
+    Encode (timestamp, checksum) pairs, giving the same slugs as
+    `librisencode`. Digits are taken three at a time from a precomputed table,
+    and rotated using translation tables.
+
+    >>> pairs = [(1483225200000, 3221225471), (0, 0), (29, 30)]
+    >>> librisencode_many(pairs) == [librisencode(a, b) for a, b in pairs]
+    True
+    """
+    alphabet, groups, rotations = lower_consonants_numbers, _DIGIT_GROUPS, _ROTATIONS
+    slugs = []
+    for a, b in pairs:
+        digits = _tobase(a)
+        if b < _MAX_CODE:
+            high, low = divmod(b, _GROUP)
+            high, mid = divmod(high, _GROUP)
+            codepart = alphabet[high] + groups[mid] + groups[low]
+        else:
+            codepart = _tobase(b)
+        slugs.append(digits[-1] + digits[-2::-1].translate(rotations[a % _SIZE]) +
+                     codepart)
+    return slugs
+
+
+def librisdecode(slug):
+    """
+    Get the (timestamp, checksum) pair encoded in slug by `librisencode`.
+
+    >>> librisdecode(librisencode(1483225200000, 3221225471))
+    (1483225200000, 3221225471)
+    >>> librisdecode(librisencode(0, 0))
+    (0, 0)
+    """
+    timepart, codepart = slug[:-CODE_WIDTH], slug[-CODE_WIDTH:]
+    if not timepart:
+        raise ValueError("Not a slug: %r" % slug)
+    last = timepart[0]
+    digits = (timepart[:0:-1].translate(
+                _UNROTATIONS[lower_consonants_numbers.index(last)]) + last)
+    return (int(digits.translate(_INT_DIGITS), _SIZE),
+            int(codepart.translate(_INT_DIGITS), _SIZE))
+
+
+def faux_offset(s):
+    """
+    Get a number derived from the characters of s, used to spread the
+    timestamps of identifiers minted at the same time.
+
+    >>> faux_offset('ab') == ord('a') * 1 + ord('b') * 4
+    True
+    """
+    if len(s) > len(_SQUARES):
+        _SQUARES.extend((i + 1) ** 2 for i in range(len(_SQUARES), len(s) * 2))
+    return sum(map(mul, map(ord, s), _SQUARES[:len(s)]))
+
+
+def encode_identifiers(timestamp, identifiers):
+    """
+    Get slugs for identifiers minted at timestamp.
+
+    >>> slugs = encode_identifiers(1483225200000, ['http://example.org/a'])
+    >>> librisdecode(slugs[0]) == (1483225200000 + faux_offset('http://example.org/a'),
+    ...                            checksum('http://example.org/a'))
+    True
+    """
+    return librisencode_many((timestamp + faux_offset(identifier), checksum(identifier))
+                             for identifier in identifiers)
+
+
+def _tobase(i):
+    groups = []
+    while i >= _GROUP:
+        i, rest = divmod(i, _GROUP)
+        groups.append(_DIGIT_GROUPS[rest])
+    groups.append(_DIGIT_GROUPS[i].lstrip(lower_consonants_numbers[0]) or
+                  lower_consonants_numbers[0])
+    return "".join(reversed(groups))
+
+
 if __name__ == '__main__':
     import sys
     import os.path as P
@@ -66,11 +169,8 @@ if __name__ == '__main__':
             assert len(frag) < 4
             timestamp += + int(frag)
 
-    def faux_offset(s):
-        return sum(ord(c) * ((i+1) ** 2)  for i, c in enumerate(s))
-
-    for identifier in identifiers:
+    slugs = encode_identifiers(int(timestamp), identifiers)
+    for identifier, slug in zip(identifiers, slugs):
         offset = faux_offset(identifier)
         check = checksum(identifier)
-        slug = librisencode(int(timestamp + offset), check)
         print("<{}> = <{}> # {}, {}".format(slug, identifier, offset, check))
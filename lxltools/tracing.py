@@ -0,0 +1,216 @@
+# -*- coding: UTF-8 -*-
+from __future__ import unicode_literals, print_function
+__metaclass__ = type
+
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock, local
+import inspect
+import time
+import types
+
+
+class Span:
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.time()
+        self.elapsed = None
+        self.children = []
+
+    def to_dict(self):
+        """
+        >>> span = Span('request')
+        >>> span.children.append(Span('child'))
+        >>> print(" ".join(sorted(span.to_dict())))
+        ms name spans
+        """
+        node = {'name': self.name, 'ms': _ms(self.elapsed)}
+        if self.children:
+            node['spans'] = [child.to_dict() for child in self.children]
+        return node
+
+
+class Tracer:
+    """
+    Records timing spans per request (per thread), and aggregate counts and
+    times per span name.
+
+    >>> tracer = Tracer()
+    >>> with tracer.request('search'):
+    ...     with tracer.span('es.search'):
+    ...         pass
+    ...     with tracer.span('stats'):
+    ...         with tracer.span('lookup'):
+    ...             pass
+    >>> timings = tracer.last_request()
+    >>> print(" ".join(span['name'] for span in timings['spans']))
+    es.search stats
+    >>> tracer.get_counters()['lookup']['count']
+    1
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self._local = local()
+        self._lock = Lock()
+
+    @contextmanager
+    def request(self, name):
+        """
+        Open a request span. Inside another request it is just a span.
+        """
+        if getattr(self._local, 'stack', None):
+            with self.span(name) as span:
+                yield span
+            return
+        root = Span(name)
+        self._local.stack = [root]
+        try:
+            yield root
+        finally:
+            self._local.stack = None
+            self._close(root)
+            self._local.last = root
+
+    @contextmanager
+    def span(self, name):
+        stack = getattr(self._local, 'stack', None)
+        span = Span(name)
+        if stack:
+            stack[-1].children.append(span)
+            stack.append(span)
+        try:
+            yield span
+        finally:
+            if stack:
+                stack.pop()
+            self._close(span)
+
+    def iterate(self, name, iterable):
+        """
+        Generate the items of iterable, recording the time spent producing
+        them (not the time spent by the consumer between them) as a span in
+        the span open when iteration starts.
+
+        >>> tracer = Tracer()
+        >>> with tracer.request('stream'):
+        ...     items = tracer.iterate('items', iter([1, 2]))
+        ...     print(list(items))
+        [1, 2]
+        >>> print(tracer.last_request()['spans'][0]['name'])
+        items
+        """
+        span = Span(name)
+        span.elapsed = 0.0
+        iterator = iter(iterable)
+        attached = False
+        try:
+            while True:
+                stack = getattr(self._local, 'stack', None)
+                if stack:
+                    if not attached:
+                        stack[-1].children.append(span)
+                        attached = True
+                    stack.append(span)
+                start = time.time()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    span.elapsed += time.time() - start
+                    if stack:
+                        stack.pop()
+                yield item
+        finally:
+            self._count(span)
+
+    def bind(self, func):
+        """
+        Wrap func so that spans opened when it runs in another thread (e.g.
+        in a thread pool) are recorded in the currently open span.
+        """
+        stack = getattr(self._local, 'stack', None)
+        parent = stack[-1] if stack else None
+        @wraps(func)
+        def bound(*args, **kws):
+            if parent is None:
+                return func(*args, **kws)
+            self._local.stack = [parent]
+            try:
+                return func(*args, **kws)
+            finally:
+                self._local.stack = None
+        return bound
+
+    def last_request(self):
+        """
+        Get the timing breakdown of the last request finished in this thread.
+        """
+        last = getattr(self._local, 'last', None)
+        return last.to_dict() if last else None
+
+    def get_counters(self):
+        with self._lock:
+            return {name: {'count': count, 'ms': _ms(total)}
+                    for name, (count, total) in self.counters.items()}
+
+    def format_metrics(self, prefix='lxltools'):
+        """
+        Format the counters in the Prometheus text exposition format.
+
+        >>> tracer = Tracer()
+        >>> with tracer.span('es.search'): pass
+        >>> print(tracer.format_metrics().splitlines()[0])
+        lxltools_span_count{span="es.search"} 1
+        """
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+        for name, (count, total) in counters:
+            lines.append('%s_span_count{span="%s"} %d' % (prefix, name, count))
+            lines.append('%s_span_seconds_total{span="%s"} %f' % (prefix, name, total))
+        return "\n".join(lines) + "\n"
+
+    def _close(self, span):
+        span.elapsed = time.time() - span.start
+        self._count(span)
+
+    def _count(self, span):
+        with self._lock:
+            count, total = self.counters.get(span.name, (0, 0.0))
+            self.counters[span.name] = (count + 1, total + span.elapsed)
+
+
+def traced(name, request=False):
+    """
+    Decorate a method to record its calls as spans in `self.tracer`. If the
+    method is a generator, or returns one (e.g. to stream from a cursor), the
+    iteration is recorded (see `Tracer.iterate`), as "<name>.iter" in the
+    latter case.
+    """
+    def decorator(func):
+        if inspect.isgeneratorfunction(func):
+            @wraps(func)
+            def iter_wrapper(self, *args, **kws):
+                return self.tracer.iterate(name, func(self, *args, **kws))
+            return iter_wrapper
+
+        @wraps(func)
+        def wrapper(self, *args, **kws):
+            tracer = self.tracer
+            with (tracer.request(name) if request else tracer.span(name)):
+                result = func(self, *args, **kws)
+            if isinstance(result, types.GeneratorType):
+                return tracer.iterate(name + '.iter', result)
+            return result
+        return wrapper
+    return decorator
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 3) if seconds is not None else None
+
+
+default_tracer = Tracer()
@@ -0,0 +1,394 @@
+# -*- coding: UTF-8 -*-
+from __future__ import unicode_literals, print_function
+__metaclass__ = type
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+import hashlib
+import json
+import mmap
+import os
+import struct
+
+from .cache import LRUCache
+from .ld.keys import ID, TYPE
+from .util import as_iterable
+
+
+SNAPSHOT_VERSION = 1
+
+WORK_TYPES = ['UniformWork', 'CreativeWork']
+AGENT_TYPES = ['Person', 'Persona', 'Family', 'Organization', 'Meeting']
+
+MAPPED_MAGIC = b'LXLVOCAB'
+_HEADER = struct.Struct(str('<IIII'))
+_ENTRY = struct.Struct(str('<IIII'))
+_IRI_ENTRY = struct.Struct(str('<III'))
+
+
+class VocabIndex:
+    """
+    The vocabulary terms, keys and label logic used to view data, without
+    any dependency on the RDF graph it was built from. Use VocabView to build
+    it from a graph, and save and load to keep it as a compiled snapshot.
+    """
+
+    def __init__(self, index, unstable_keys, label_keys, lang='en',
+            partof_keys=None, source_hash=None):
+        self.index = index
+        self.unstable_keys = set(unstable_keys)
+        self.label_keys = label_keys
+        self.lang = lang
+        self.partof_keys = partof_keys or [
+                'inScheme', 'isDefinedBy', 'inCollection', 'inDataset']
+        self.source_hash = source_hash
+        self._rank_keys()
+        self._compile_labels()
+
+    @classmethod
+    def load(cls, fpath):
+        with open(fpath, 'rb') as fp:
+            data = json.loads(fp.read().decode('utf-8'))
+        if data.get('version') != SNAPSHOT_VERSION:
+            raise ValueError("Unsupported vocab snapshot version: %s" % data.get('version'))
+        return cls(data['index'], data['unstable_keys'], data['label_keys'],
+                   data['lang'], data['partof_keys'], data.get('source_hash'))
+
+    def save(self, fpath):
+        data = {
+            'version': SNAPSHOT_VERSION,
+            'source_hash': self.source_hash,
+            'lang': self.lang,
+            'label_keys': self.label_keys,
+            'partof_keys': self.partof_keys,
+            'unstable_keys': sorted(self.unstable_keys),
+            'index': self.index
+        }
+        tmp_path = fpath + '.tmp'
+        with open(tmp_path, 'wb') as fp:
+            fp.write(json.dumps(data, separators=(',', ':'),
+                                sort_keys=True).encode('utf-8'))
+        os.rename(tmp_path, fpath)
+
+    @classmethod
+    def load_mapped(cls, fpath):
+        """
+        Load a vocabulary index written by save_mapped. The terms are read
+        on demand from a read-only memory map, which is shared between all
+        processes using the same file.
+        """
+        index = MappedIndex(fpath)
+        meta = index.meta
+        return cls(index, meta['unstable_keys'], meta['label_keys'],
+                   meta['lang'], meta['partof_keys'], meta.get('source_hash'))
+
+    def save_mapped(self, fpath):
+        meta = {
+            'lang': self.lang,
+            'label_keys': self.label_keys,
+            'partof_keys': self.partof_keys,
+            'unstable_keys': sorted(self.unstable_keys),
+            'source_hash': self.source_hash
+        }
+        write_mapped_index(fpath, self.index, meta)
+
+    def _rank_keys(self):
+        self.label_ranks = {key: i for i, key in enumerate(self.label_keys)}
+        self.partof_ranks = {key: i for i, key in enumerate(self.partof_keys)}
+
+    def sortedkeys(self, item):
+        # TODO: groups:
+        #   - main: labels, descriptions, type-close links, notes
+        #   - provenance: dates, publication, ...
+        #   - for pages/records:
+        #       - administrativa: created, updated
+        #       - structural navigation: prev, next, alternate formats
+        typeprops = set()
+        for itype in as_iterable(item.get(TYPE)):
+            typedfn = self.index.get(itype)
+            if typedfn:
+                typeprops.update(typedfn.get('properties', []))
+
+        label_ranks = self.label_ranks
+        partof_ranks = self.partof_ranks
+
+        def keykey(key):
+            is_kw = key.startswith('@')
+            is_unstable = key in self.unstable_keys
+            label_number = label_ranks.get(key, len(label_ranks))
+            partof_number = partof_ranks.get(key, len(partof_ranks))
+            is_link = self.index[key].get(TYPE) == ID
+            classdistance = 0 if typeprops and key in typeprops else 1
+            return (is_kw,
+                    partof_number,
+                    label_number,
+                    is_link,
+                    classdistance,
+                    key)
+
+        # Changing language containers to simple values...
+        # TODO:
+        # - either support containers by properly using the context
+        # - or optimize this rewriting
+        # - or do not allow this form (remove from base context)
+        for key in list(item.keys()):
+            if key.endswith('ByLang'):
+                v = item.pop(key).get(self.lang)
+                newk = key[:-len('ByLang')]
+                item[newk] = v
+
+        return sorted((key for key in item
+            if key in self.index
+            and key not in self.unstable_keys), key=keykey)
+
+    def _compile_labels(self):
+        self._label_lookups = [(lkey, lkey + 'ByLang') for lkey in self.label_keys]
+        # In order of precedence, if an item has several types.
+        formatters = [(WORK_TYPES, self._format_work),
+                      (AGENT_TYPES, self._format_agent)]
+        self._label_formatters = {}
+        for precedence, (types, formatter) in enumerate(formatters):
+            for rtype in types:
+                self._label_formatters[rtype] = (precedence, formatter)
+
+    def get_label_for(self, item):
+        focus = item.get('focus')
+        if focus:
+            label = self.construct_label(focus)
+            if label:
+                return label
+
+        if 'prefLabel' not in item: # ComplexTerm in types
+            termparts = item.get('termParts', [])
+            if termparts:
+                return " - ".join(self.labelgetter(bit) for bit in termparts)
+
+        return self.labelgetter(item)
+
+    def construct_label(self, item):
+        chosen = None
+        for rtype in as_iterable(item.get(TYPE)):
+            candidate = self._label_formatters.get(rtype)
+            if candidate and (chosen is None or candidate[0] < chosen[0]):
+                chosen = candidate
+        if chosen:
+            return chosen[1](item)
+
+    def _format_work(self, item):
+        label = self.labelgetter(item)
+        attr = item.get('attributedTo')
+        if attr:
+            attr_label = self.construct_label(attr)
+            if attr_label:
+                label = "%s (%s)" % (label, attr_label)
+        return label
+
+    def _format_agent(self, item):
+        has = item.__contains__
+        v = lambda k: " ".join(as_iterable(item.get(k, '')))
+        vs = lambda *ks: [v(k) for k in ks if has(k)]
+        return " ".join([
+                v('name') or ", ".join(vs('familyName', 'givenName')),
+                v('numeration'),
+                "(%s)" % v('personTitle') if has('personTitle') else "",
+                "%s-%s" % (v('birthYear'), v('deathYear'))
+                if (has('birthYear') or has('deathYear')) else ""])
+
+    def labelgetter(self, item):
+        for lkey, bylang_key in self._label_lookups:
+            label = item.get(lkey)
+            if not label:
+                for label in as_iterable(item.get(bylang_key)):
+                    label = label.get(self.lang)
+                    if label:
+                        break
+            if label:
+                if isinstance(label, list):
+                    return label[0]
+                return label
+        return ""
+
+
+class MappedIndex(Mapping):
+    """
+    A read-only mapping of vocabulary keys to terms, backed by a memory
+    mapped file. The file holds a header, a key table and an IRI table
+    sorted for binary search, and the terms as JSON.
+    """
+
+    def __init__(self, fpath, cache_size=1000):
+        with open(fpath, 'rb') as fp:
+            self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAPPED_MAGIC)] != MAPPED_MAGIC:
+            raise ValueError("Not a mapped vocabulary index: %s" % fpath)
+        pos = len(MAPPED_MAGIC)
+        version, meta_len, self._count, self._iri_count = _HEADER.unpack_from(
+                self._map, pos)
+        if version != SNAPSHOT_VERSION:
+            raise ValueError("Unsupported vocab index version: %s" % version)
+        pos += _HEADER.size
+        self.meta = json.loads(self._map[pos:pos + meta_len].decode('utf-8'))
+        self._entries = pos + meta_len
+        self._iri_entries = self._entries + self._count * _ENTRY.size
+        self._data = self._iri_entries + self._iri_count * _IRI_ENTRY.size
+        self._cache = LRUCache(cache_size)
+
+    def __getitem__(self, key):
+        term = self._cache.get(key)
+        if term is None:
+            i = self._find(key.encode('utf-8'))
+            if i is None:
+                raise KeyError(key)
+            term = self._term_at(i)
+            self._cache.set(key, term)
+        return term
+
+    def __contains__(self, key):
+        return key in self._cache or self._find(key.encode('utf-8')) is not None
+
+    def __iter__(self):
+        for i in range(self._count):
+            yield self._key_at(i).decode('utf-8')
+
+    def __len__(self):
+        return self._count
+
+    def by_iri(self, iri):
+        """
+        Get the term with the given IRI, or None.
+        """
+        iri = iri.encode('utf-8')
+        lo, hi = 0, self._iri_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset, length, i = _IRI_ENTRY.unpack_from(self._map,
+                    self._iri_entries + mid * _IRI_ENTRY.size)
+            candidate = self._map[self._data + offset:self._data + offset + length]
+            if candidate < iri:
+                lo = mid + 1
+            elif candidate > iri:
+                hi = mid
+            else:
+                return self[self._key_at(i).decode('utf-8')]
+        return None
+
+    def close(self):
+        self._map.close()
+
+    def _find(self, key):
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            candidate = self._key_at(mid)
+            if candidate < key:
+                lo = mid + 1
+            elif candidate > key:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def _key_at(self, i):
+        offset, length, _, _ = _ENTRY.unpack_from(self._map,
+                self._entries + i * _ENTRY.size)
+        return self._map[self._data + offset:self._data + offset + length]
+
+    def _term_at(self, i):
+        _, _, offset, length = _ENTRY.unpack_from(self._map,
+                self._entries + i * _ENTRY.size)
+        return json.loads(self._map[self._data + offset:
+                                    self._data + offset + length].decode('utf-8'))
+
+
+def write_mapped_index(fpath, index, meta):
+    keys = sorted(key.encode('utf-8') for key in index)
+    data = bytearray()
+    entries = []
+    iris = []
+    for i, key in enumerate(keys):
+        term = index[key.decode('utf-8')]
+        value = json.dumps(term, separators=(',', ':'), sort_keys=True).encode('utf-8')
+        entries.append(_ENTRY.pack(len(data), len(key), len(data) + len(key), len(value)))
+        data += key + value
+        if term.get(ID):
+            iris.append((term[ID].encode('utf-8'), i))
+    iri_entries = []
+    for iri, i in sorted(iris):
+        iri_entries.append(_IRI_ENTRY.pack(len(data), len(iri), i))
+        data += iri
+
+    meta_data = json.dumps(meta, sort_keys=True).encode('utf-8')
+    tmp_path = fpath + '.tmp'
+    with open(tmp_path, 'wb') as fp:
+        fp.write(MAPPED_MAGIC)
+        fp.write(_HEADER.pack(SNAPSHOT_VERSION, len(meta_data), len(entries),
+                              len(iri_entries)))
+        fp.write(meta_data)
+        fp.write(b''.join(entries))
+        fp.write(b''.join(iri_entries))
+        fp.write(bytes(data))
+    os.rename(tmp_path, fpath)
+
+
+def load_compiled(snapshot_path, sources, vocab_uri, lang='en', mapped=False):
+    """
+    Load a vocabulary index from a compiled snapshot. If the snapshot is
+    missing or was compiled from other source contents, compile it anew
+    from the source files (which requires rdflib) and save it. With mapped,
+    the snapshot is in the memory mapped format (see MappedIndex).
+    """
+    source_hash = hash_sources(sources, vocab_uri, lang)
+    load = VocabIndex.load_mapped if mapped else VocabIndex.load
+    if os.path.exists(snapshot_path):
+        try:
+            vocab = load(snapshot_path)
+            if vocab.source_hash == source_hash:
+                return vocab
+        except ValueError:
+            pass
+    vocab = compile_vocab(sources, vocab_uri, lang)
+    vocab.source_hash = source_hash
+    if mapped:
+        vocab.save_mapped(snapshot_path)
+        return load(snapshot_path)
+    vocab.save(snapshot_path)
+    return vocab
+
+
+def compile_vocab(sources, vocab_uri, lang='en'):
+    from rdflib import ConjunctiveGraph
+    from rdflib.util import guess_format
+    from .vocabview import VocabView
+
+    graph = ConjunctiveGraph()
+    for source in sources:
+        graph.parse(source, format=guess_format(source))
+    view = VocabView(graph, vocab_uri, lang)
+    return VocabIndex(view.index, view.unstable_keys, view.label_keys, lang,
+                      view.partof_keys)
+
+
+def hash_sources(sources, *params):
+    digest = hashlib.sha1()
+    digest.update(("%s %s" % (SNAPSHOT_VERSION, " ".join(params))).encode('utf-8'))
+    for source in sources:
+        with open(source, 'rb') as fp:
+            digest.update(fp.read())
+    return digest.hexdigest()
+
+
+if __name__ == '__main__':
+    import sys
+    args = sys.argv[1:]
+    mapped = '--mapped' in args
+    if mapped:
+        args.remove('--mapped')
+    if len(args) < 3:
+        print("Usage: %s [--mapped] SNAPSHOT VOCAB_URI SOURCE..." % sys.argv[0],
+              file=sys.stderr)
+        exit(1)
+    snapshot_path, vocab_uri = args[:2]
+    vocab = load_compiled(snapshot_path, args[2:], vocab_uri, mapped=mapped)
+    print("Compiled %d terms to %s" % (len(vocab.index), snapshot_path))
@@ -6,7 +6,7 @@ from rdflib import Graph, Literal, URIRef, Namespace, RDF, RDFS, OWL
 from rdflib.resource import Resource
 
 from .ld.keys import ID, TYPE
-from .util import as_iterable
+from .vocabindex import VocabIndex
 
 
 SDO = Namespace("http://schema.org/")
@@ -69,7 +69,7 @@ class VocabUtil:
                 yield o
 
 
-class VocabView:
+class VocabView(VocabIndex):
 
     def __init__(self, vocab_graph, vocab_uri, lang='en'):
         self.index = {}
@@ -87,6 +87,9 @@ class VocabView:
 
         label_key_items = [(0, 'hasTitle')]
 
+        superprops = property_closure(g,
+                (RDFS.subPropertyOf, OWL.equivalentProperty))
+
         for s in set(g.subjects()):
             if not isinstance(s, URIRef):
                 continue
@@ -118,8 +121,7 @@ class VocabView:
                 self.unstable_keys.add(key)
 
             def distance_to(prop):
-                return path_distance(g, s,
-                    RDFS.subPropertyOf | OWL.equivalentProperty, prop)
+                return 0 if s == prop else superprops.get(s, {}).get(prop)
 
             label_distance = distance_to(BASE_LABEL)
 
@@ -132,114 +134,15 @@ class VocabView:
 
         self.label_keys = [key for ldist, key in sorted(label_key_items, reverse=True)]
 
-        self.partof_keys = ['inScheme', 'isDefinedBy', 'inCollection', 'inDataset']
-        # TODO: generate vocab-json for label keys, sorting etc.
-        #import pprint
-        #pprint.pprint(self.index)
-
-    def sortedkeys(self, item):
-        # TODO: groups:
-        #   - main: labels, descriptions, type-close links, notes
-        #   - provenance: dates, publication, ...
-        #   - for pages/records:
-        #       - administrativa: created, updated
-        #       - structural navigation: prev, next, alternate formats
-        typeprops = set()
-        for itype in as_iterable(item.get(TYPE)):
-            typedfn = self.index.get(itype)
-            if typedfn:
-                typeprops.update(typedfn.get('properties', []))
-
-        def keykey(key):
-            is_kw = key.startswith('@')
-            is_unstable = key in self.unstable_keys
-            try:
-                label_number = self.label_keys.index(key)
-            except ValueError:
-                label_number = len(self.label_keys)
-            try:
-                partof_number = self.partof_keys.index(key)
-            except ValueError:
-                partof_number = len(self.partof_keys)
-            is_link = self.index[key].get(TYPE) == ID
-            classdistance = 0 if typeprops and key in typeprops else 1
-            return (is_kw,
-                    partof_number,
-                    label_number,
-                    is_link,
-                    classdistance,
-                    key)
-
-        # Changing language containers to simple values...
-        # TODO:
-        # - either support containers by properly using the context
-        # - or optimize this rewriting
-        # - or do not allow this form (remove from base context)
-        for key in list(item.keys()):
-            if key.endswith('ByLang'):
-                v = item.pop(key).get(self.lang)
-                newk = key[:-len('ByLang')]
-                item[newk] = v
-
-        return sorted((key for key in item
-            if key in self.index
-            and key not in self.unstable_keys), key=keykey)
-
-    def get_label_for(self, item):
-        focus = item.get('focus')
-        if focus:
-            label = self.construct_label(focus)
-            if label:
-                return label
-
-        if 'prefLabel' not in item: # ComplexTerm in types
-            termparts = item.get('termParts', [])
-            if termparts:
-                return " - ".join(self.labelgetter(bit) for bit in termparts)
-
-        return self.labelgetter(item)
-
-    def construct_label(self, item):
-        has = item.__contains__
-        v = lambda k: " ".join(as_iterable(item.get(k, '')))
-        vs = lambda *ks: [v(k) for k in ks if has(k)]
-
-        types = set(as_iterable(item.get(TYPE)))
-
-        if types & {'UniformWork', 'CreativeWork'}:
-            label = self.labelgetter(item)
-            attr = item.get('attributedTo')
-            if attr:
-                attr_label = self.construct_label(attr)
-                if attr_label:
-                    label = "%s (%s)" % (label, attr_label)
-            return label
-
-        if types & {'Person', 'Persona', 'Family', 'Organization', 'Meeting'}:
-            return " ".join([
-                    v('name') or ", ".join(vs('familyName', 'givenName')),
-                    v('numeration'),
-                    "(%s)" % v('personTitle') if has('personTitle') else "",
-                    "%s-%s" % (v('birthYear'), v('deathYear'))
-                    if (has('birthYear') or has('deathYear')) else ""])
-
-    def labelgetter(self, item):
-        for lkey in self.label_keys:
-            label = item.get(lkey)
-            if not label:
-                for label in as_iterable(item.get(lkey + 'ByLang')):
-                    label = label.get(self.lang)
-                    if label:
-                        break
-            if label:
-                if isinstance(label, list):
-                    return label[0]
-                return label
-        return ""
+        VocabIndex.__init__(self, self.index, self.unstable_keys,
+                self.label_keys, lang)
 
 
-def path_distance(g, s, p, base):
+def property_closure(g, preds):
     """
+    Map each subject of the given predicates to the shortest distances to
+    everything reachable from it through them.
+
     >>> ns = Namespace("urn:x-ns:")
     >>> g = Graph()
     >>> subpropof = RDFS.subPropertyOf
@@ -247,28 +150,36 @@ def path_distance(g, s, p, base):
     >>> g.add((ns.title, subpropof, ns.name))
     >>> g.add((ns.notation, subpropof, ns.title))
     >>> g.add((ns.notation, subpropof, ns.name))
+    >>> g.add((ns.label, OWL.equivalentProperty, ns.name))
 
-    >>> path_distance(g, ns.comment, subpropof, ns.label)
-    >>> path_distance(g, ns.label, subpropof, ns.label)
-    0
-    >>> path_distance(g, ns.name, subpropof, ns.label)
-    1
-    >>> path_distance(g, ns.title, subpropof, ns.label)
+    >>> closure = property_closure(g, (subpropof, OWL.equivalentProperty))
+    >>> closure[ns.title][ns.label]
+    2
+    >>> closure[ns.notation][ns.label]
     2
-    >>> path_distance(g, ns.notation, subpropof, ns.label)
+    >>> closure[ns.label][ns.label]
     2
+    >>> ns.comment in closure
+    False
     """
-    if s == base:
-        return 0
-    def find_path(s, distance=1):
-        shortest = None
-        for o in g.objects(s, p):
-            if o == base:
-                return distance
-            else:
-                candidate = find_path(o, distance+1)
-                if shortest is None or (candidate is not None
-                        and candidate < shortest):
-                    shortest = candidate
-        return shortest
-    return find_path(s)
+    edges = {}
+    for p in preds:
+        for s, o in g.subject_objects(p):
+            edges.setdefault(s, set()).add(o)
+
+    closure = {}
+    for start in edges:
+        distances = {}
+        frontier = [start]
+        distance = 0
+        while frontier:
+            distance += 1
+            next_frontier = []
+            for s in frontier:
+                for o in edges.get(s, ()):
+                    if o not in distances:
+                        distances[o] = distance
+                        next_frontier.append(o)
+            frontier = next_frontier
+        closure[start] = distances
+    return closure
@@ -0,0 +1,239 @@
+from __future__ import unicode_literals
+import gzip
+import io
+import os
+import shutil
+import tempfile
+import threading
+from os import path as P
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import pytest
+
+datacompiler = pytest.importorskip('lxltools.datacompiler')
+
+
+NAMES = ['one', 'two', 'three']
+
+
+def _make_compiler(base_dir):
+    compiler = datacompiler.Compiler(base_dir=base_dir,
+                                     dataset_id='http://example.org/dataset/',
+                                     system_base_iri='http://example.org/')
+
+    for name in NAMES:
+        def build(name=name):
+            label = compiler.load_json('%s.json' % name)['label']
+            return ('/%s/' % name, '2017-01-01T00:00:00.000Z', {'@graph': [
+                {'@id': 'http://example.org/%s/%s' % (name, i), 'name': label}
+                for i in range(3)]})
+        build.__name__ = str(name)
+        compiler.dataset(build)
+
+    return compiler
+
+
+def _write_input(base_dir, name, label):
+    with io.open(P.join(base_dir, '%s.json' % name), 'w', encoding='utf-8') as f:
+        f.write('{"label": "%s"}' % label)
+
+
+def _compile(base_dir, jobs=1, **kws):
+    compiler = _make_compiler(base_dir)
+    compiler._configure(P.join(base_dir, 'build'), use_union=True, jobs=jobs, **kws)
+    compiler._run(NAMES)
+    if kws.get('compression') == 'gzip':
+        with gzip.open(P.join(base_dir, 'build', compiler.union + '.gz')) as f:
+            return f.read().decode('utf-8')
+    with io.open(P.join(base_dir, 'build', compiler.union), encoding='utf-8') as f:
+        return f.read()
+
+
+@pytest.fixture
+def base_dir():
+    tmpdir = tempfile.mkdtemp()
+    for name in NAMES:
+        _write_input(tmpdir, name, name)
+    yield tmpdir
+    shutil.rmtree(tmpdir)
+
+
+def test_parallel_compile_keeps_order(base_dir):
+    lines = _compile(base_dir)
+    assert len(lines.splitlines()) == 9
+    shutil.rmtree(P.join(base_dir, 'build'))
+    assert _compile(base_dir, jobs=3) == lines
+
+
+def test_unchanged_datasets_are_skipped(base_dir, capsys):
+    lines = _compile(base_dir)
+    capsys.readouterr()
+    assert _compile(base_dir) == lines
+    assert capsys.readouterr()[0].count('Unchanged') == 3
+
+    _write_input(base_dir, 'two', 'changed')
+    lines = _compile(base_dir)
+    assert capsys.readouterr()[0].count('Unchanged') == 2
+    assert lines.count('changed') == 3
+
+
+def test_configuration_changes_are_rebuilt(base_dir, capsys):
+    _compile(base_dir, write_files=False)
+    lines = _compile(base_dir)
+    assert 'Unchanged' not in capsys.readouterr()[0]
+    assert P.exists(P.join(base_dir, 'build', 'one', '0.jsonld'))
+
+    assert _compile(base_dir, system_base_iri='http://example.net/') != lines
+    assert 'Unchanged' not in capsys.readouterr()[0]
+
+
+def test_compressed_lines_only(base_dir):
+    lines = _compile(base_dir)
+    shutil.rmtree(P.join(base_dir, 'build'))
+    assert _compile(base_dir, compression='gzip', write_files=False) == lines
+    assert not any(fname.endswith('.jsonld')
+                   for dirpath, dirnames, fnames in os.walk(base_dir)
+                   for fname in fnames)
+
+
+@pytest.mark.parametrize('jobs', [1, 3])
+def test_record_id_collisions(base_dir, monkeypatch, jobs):
+    monkeypatch.setattr(datacompiler.lxlslug, 'encode_identifiers',
+                        lambda timestamp, identifiers: ['same'] * len(identifiers))
+    compiler = _make_compiler(base_dir)
+    compiler._configure(P.join(base_dir, 'build'), jobs=jobs)
+    compiler._run(NAMES)
+    assert compiler.record_ids == {'http://example.org/same': 'http://example.org/one/0'}
+    assert sorted(node_id for record_id, known_id, node_id
+                  in compiler.record_id_collisions) == sorted(
+        'http://example.org/%s/%s' % (name, i)
+        for name in NAMES for i in range(3))[1:]
+
+
+def test_to_jsonld():
+    from rdflib import BNode, Graph, Literal, Namespace, RDF, URIRef
+    ns = Namespace('http://example.org/ns/')
+    context = {'@context': {'@vocab': ns, 'ex': 'http://example.org/'}}
+    graph = Graph()
+    thing, other = URIRef('http://example.org/thing'), URIRef('http://example.org/other')
+    note, shared = BNode(), BNode()
+    graph.add((thing, RDF.type, ns.Thing))
+    graph.add((thing, ns.note, note))
+    graph.add((note, ns.label, Literal('Note')))
+    graph.add((thing, ns.related, shared))
+    graph.add((other, ns.related, shared))
+    graph.add((shared, ns.label, Literal('Shared')))
+    graph.add((other, ns.seeAlso, thing))
+
+    data = datacompiler._to_jsonld(graph, '../context.jsonld', context)
+    assert data['@context'] == '../context.jsonld'
+    nodes = data['@graph']
+    assert [node['@id'] for node in nodes] == [
+        shared.n3(), 'http://example.org/other', 'http://example.org/thing']
+    assert nodes[1]['seeAlso'] == {'@id': 'http://example.org/thing'}
+    assert nodes[2]['note'] == {'label': 'Note'}
+    assert nodes[2]['related'] == {'@id': shared.n3()}
+
+
+def test_cached_construct(base_dir, monkeypatch):
+    with io.open(P.join(base_dir, 'data.rdf'), 'w', encoding='utf-8') as f:
+        f.write('<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"'
+                ' xmlns:ns="http://example.org/ns/">'
+                '<rdf:Description rdf:about="http://example.org/a">'
+                '<ns:p>A</ns:p></rdf:Description></rdf:RDF>')
+    with io.open(P.join(base_dir, 'query.rq'), 'w', encoding='utf-8') as f:
+        f.write('CONSTRUCT { ?s <http://example.org/ns/q> ?o } WHERE { ?s ?p ?o }')
+    compiler = datacompiler.Compiler(base_dir=base_dir)
+    compiler._configure(P.join(base_dir, 'build'), P.join(base_dir, 'cache'))
+    sources = [{'source': P.join(base_dir, 'data.rdf')}]
+
+    result = compiler.construct(sources, 'query.rq')
+    assert len(result) == 1
+
+    def fail(*args, **kws):
+        raise AssertionError("Query was run")
+    monkeypatch.setattr(datacompiler.ConjunctiveGraph, 'query', fail)
+    assert set(compiler.construct(sources, 'query.rq')) == set(result)
+    with pytest.raises(AssertionError):
+        compiler.construct(sources, 'query.rq', refresh=True)
+
+
+def test_construct_key_of_remote_source(base_dir):
+    with io.open(P.join(base_dir, 'query.rq'), 'w', encoding='utf-8') as f:
+        f.write('CONSTRUCT WHERE { ?s ?p ?o }')
+    compiler = datacompiler.Compiler(base_dir=base_dir)
+    compiler._configure(P.join(base_dir, 'build'), P.join(base_dir, 'cache'))
+    compiler.cachedir.mkdir(parents=True)
+    url = 'http://example.org/data'
+    sources = [{'source': url}]
+    raw_path = compiler.get_cached_path(url)
+    with raw_path.open('wb') as f:
+        f.write(b'A')
+
+    compiler._build_entry = {'inputs': {}, 'sources': []}
+    key = datacompiler._get_construct_key(compiler, sources, 'query.rq')
+    assert compiler._build_entry['sources'] == [url]
+    assert '%s' % raw_path in compiler._build_entry['inputs']
+
+    with raw_path.open('wb') as f:
+        f.write(b'B')
+    assert datacompiler._get_construct_key(compiler, sources, 'query.rq') != key
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    body = b'A'
+    etag = '"a"'
+    requests = []
+
+    def do_GET(self):
+        _Handler.requests.append((self.path, self.headers.get('If-None-Match')))
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', self.etag)
+        self.send_header('Content-Type', 'text/plain')
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = HTTPServer(('127.0.0.1', 0), _Handler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    _Handler.body, _Handler.etag, _Handler.requests = b'A', '"a"', []
+    yield 'http://127.0.0.1:%s' % httpd.server_address[1]
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_prefetch_and_revalidate(base_dir, server):
+    compiler = datacompiler.Compiler(base_dir=base_dir)
+    compiler._configure(P.join(base_dir, 'build'), P.join(base_dir, 'cache'))
+    urls = [server + '/one', server + '/two']
+
+    compiler.prefetch(urls)
+    assert sorted(path for path, etag in _Handler.requests) == ['/one', '/two']
+    with compiler.cache_url(urls[0]).open('rb') as f:
+        assert f.read() == b'A'
+
+    _Handler.requests = []
+    compiler.prefetch(urls)
+    assert _Handler.requests == []
+    compiler.prefetch(urls, revalidate=True)
+    assert sorted(_Handler.requests) == [('/one', '"a"'), ('/two', '"a"')]
+
+    _Handler.body, _Handler.etag = b'B', '"b"'
+    compiler.prefetch(urls[:1], revalidate=True)
+    with compiler.cache_url(urls[0]).open('rb') as f:
+        assert f.read() == b'B'
+    assert not any(fname.endswith('.tmp') for fname in os.listdir(P.join(base_dir, 'cache')))
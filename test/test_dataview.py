@@ -0,0 +1,288 @@
+from __future__ import unicode_literals
+import threading
+import time
+import pytest
+
+try:
+    from lxltools import dataview
+    from lxltools.lddb.storage import Record
+    from lxltools.tracing import Tracer, traced
+except ImportError as e:
+    pytest.skip("Cannot import dataview: %s" % e, allow_module_level=True)
+
+
+class FakeVocab:
+    label_keys = ['label']
+    index = {}
+
+    def get_label_for(self, item):
+        return item.get('label')
+
+
+class FakeStorage:
+
+    def __init__(self, changes):
+        self.changes = changes
+        self.calls = []
+
+    def get_last_change(self):
+        if self.changes:
+            last = self.changes[-1][0]
+            return last.modified, last.identifier
+
+    def find_changes(self, since=None, limit=None):
+        self.calls.append((since, limit))
+        return [(rec, deleted) for rec, deleted in self.changes
+                if not since or (rec.modified, rec.identifier) > since][:limit]
+
+
+def _record(n, modified='2016-01-01'):
+    return Record('/record/%s' % n, {'@graph': [{'@id': '/thing/%s' % n}]},
+                  modified, modified)
+
+
+def test_follow_changes():
+    storage = FakeStorage([(_record(n), False) for n in range(5)])
+    view = dataview.DataView(FakeVocab(), storage, None, None)
+    assert view.follow_changes() == 0
+    assert storage.calls == []
+
+    view.chip_cache.put('/thing/7', {'@id': '/thing/7'}, 'Seven')
+    storage.changes += [(_record(n), False) for n in range(5, 8)]
+    assert view.follow_changes(batch_size=2) == 3
+    assert [limit for since, limit in storage.calls] == [2, 2]
+    assert view.last_change == ('2016-01-01', '/record/7')
+    assert view.chip_cache.get('/thing/7') is None
+
+
+class FakeRequest:
+    path = '/_find'
+    query_string = 'q=Some+One'
+
+    def __init__(self, **args):
+        self.args = args
+
+
+def test_find_ambiguity_bounds_ranked_ties():
+    things = [{'@id': '/thing/%s' % n, '@type': 'Person', 'label': 'Some One'}
+              for n in range(50)]
+    counted = []
+
+    class AmbiguityStorage:
+        def find_by_example(self, example, limit=None, stream=False):
+            return [Record('/record/%s' % i, {'@graph': [thing]}, None, None)
+                    for i, thing in enumerate(things)]
+
+        def count_quotations(self, identifiers):
+            counted.extend(identifiers)
+            return {'/thing/7': 2}
+
+    view = dataview.DataView(FakeVocab(), AmbiguityStorage(), None, None)
+    result = view.find_ambiguity(FakeRequest(type=['Person'], q=['Some One'],
+                                             limit=['5']))
+    item = result['@graph'][0]
+    assert len(counted) == 10
+    assert [thing['@id'] for thing in item['maybe']][:2] == ['/thing/7', '/thing/0']
+    assert item['totalItems'] == 50
+
+
+def test_streamed_search_timings():
+    class StreamStorage:
+        tracer = Tracer()
+
+        @traced('storage.find_by_relation')
+        def find_by_relation(self, p, o, limit=None, offset=None, stream=False):
+            return (_record(n) for n in range(3))
+
+    storage = StreamStorage()
+    view = dataview.DataView(FakeVocab(), storage, None, None, tracer=storage.tracer)
+    chunks = view.iter_search_results({'p': 'rel', 'o': '/thing/0'},
+                                      lambda **kws: '/find')
+    assert next(chunks).endswith('"items": [')
+    assert view.get_timings() is None
+    list(chunks)
+
+    timings = view.get_timings()
+    assert timings['name'] == 'dataview.iter_search_results'
+    items = [span for span in timings['spans'] if span['name'] == 'dataview.items'][0]
+    assert [span['name'] for span in items['spans']] == (
+        ['storage.find_by_relation.iter'] + ['dataview.get_decorated_record'] * 3)
+
+
+class LookupStorage:
+
+    def __init__(self, release=None):
+        self.release = release
+
+    def get_record(self, item_id):
+        if item_id == '/slow' and self.release:
+            self.release.wait(5)
+        return Record('/record' + item_id,
+                      {'@graph': [{'@id': item_id, 'label': item_id.upper()}]},
+                      '2016-01-01', '2016-01-01')
+
+
+def test_concurrent_lookups_with_deadline():
+    ids = ['/a', '/b', '/slow', '/c']
+    serial = dataview.DataView(FakeVocab(), LookupStorage(), None, None)
+    expected = serial._map(serial.lookup, ids)
+    assert [chip['label'] for chip in expected] == ['/A', '/B', '/SLOW', '/C']
+
+    release = threading.Event()
+    view = dataview.DataView(FakeVocab(), LookupStorage(release), None, None,
+                             max_workers=4)
+    try:
+        results = view._map(view.lookup, ids, time.time() + 0.2,
+                            fallback=dataview._placeholder)
+    finally:
+        release.set()
+    assert results == expected[:2] + [dataview._placeholder('/slow')] + expected[3:]
+
+    with pytest.raises(dataview.TimeoutError):
+        release.clear()
+        try:
+            view._map(view.lookup, ['/a', '/slow'], time.time() + 0.1)
+        finally:
+            release.set()
+
+
+def test_search_links_with_cursor():
+    from lxltools.lddb.search import EmbeddedSearch
+    index = EmbeddedSearch()
+    for n in range(3):
+        index.add('/thing/%s' % n, {'@id': '/thing/%s' % n, '@type': 'Person',
+                                    'label': 'Some %s' % n, 'modified': '2016'})
+    view = dataview.DataView(FakeVocab(), LookupStorage(), index, 'lddb')
+
+    def make_find_url(**kws):
+        return '/find?' + '&'.join('%s=%s' % (k, v) for k, v in sorted(kws.items())
+                                   if v is not None)
+
+    results = view.get_search_results({'q': 'some', 'limit': '2'}, make_find_url)
+    assert view.chip_cache.get('/thing/0').modified == '2016'
+    next_link = results['next']['@id']
+    assert 'after=' in next_link and 'offset=2' in next_link
+
+    after = next_link.split('after=')[1].split('&')[0]
+    results = view.get_search_results({'q': 'some', 'limit': '2', 'after': after},
+                                      make_find_url)
+    assert [item['@id'] for item in results['items']] == ['/thing/2']
+    facet_links = [observation['view']['@id'] for observation in
+                   results['stats']['sliceByDimension']['@type']['observation']]
+    assert facet_links == ['/find?limit=2&q=some&@type=Person']
+
+
+class FakeElastic:
+
+    def __init__(self):
+        self.index_total = 0
+        self.indices = self
+
+    def stats(self, index=None, metric=None):
+        indexing = {'index_total': self.index_total, 'delete_total': 0}
+        return {'_all': {'primaries': {'indexing': indexing}}}
+
+
+def _wait_for_refresh(stats):
+    for i in range(500):
+        if not stats._refreshing:
+            return
+        time.sleep(0.01)
+    raise AssertionError("Refresh did not finish")
+
+
+def test_stats_cache_refresh_and_persistence(tmpdir):
+    elastic = FakeElastic()
+    view = dataview.DataView(FakeVocab(), None, elastic, 'lddb')
+    path = str(tmpdir.join('stats.json'))
+    released = []
+    stats = dataview.StatsCache(ttl=0, get_generation=view.get_index_generation,
+                                path=path, on_thread_exit=lambda: released.append(1))
+    builds = []
+
+    def build():
+        builds.append(elastic.index_total)
+        return len(builds)
+
+    assert stats.get('key', build) == 1
+
+    # Stale, but with an unchanged generation: only checked
+    time.sleep(0.01)
+    assert stats.get('key', build) == 1
+    _wait_for_refresh(stats)
+    assert builds == [0] and released == [1]
+
+    # The stale value is served while it is rebuilt
+    elastic.index_total = 1
+    rebuilding, done = threading.Event(), threading.Event()
+
+    def slow_build():
+        rebuilding.set()
+        done.wait(5)
+        return build()
+
+    time.sleep(0.01)
+    assert stats.get('key', slow_build) == 1
+    assert rebuilding.wait(5)
+    assert stats.get('key', slow_build) == 1
+    done.set()
+    _wait_for_refresh(stats)
+    assert builds == [0, 1]
+
+    reloaded = dataview.StatsCache(ttl=60, path=path)
+    assert reloaded.get('key', build) == 2
+    assert builds == [0, 1]
+
+
+def test_references_through_aliases():
+    item = {'@id': '/thing/1', 'sameAs': [{'@id': '/alias/1'}]}
+    quoting = Record('/record/2', {'@graph': [
+        {'@id': '/record/2', 'mainEntity': {'@id': '/work/2'}},
+        {'@id': '/work/2', 'label': 'Work', 'subject': {'@id': '/other/1'}},
+        {'@graph': {'@id': '/other/1', 'sameAs': [{'@id': '/alias/1'}]}}
+    ]}, '2016-01-01', '2016-01-01')
+    queried = []
+
+    class QuotationStorage:
+        def find_by_quotation(self, identifiers, limit=None):
+            queried.append(identifiers)
+            return [quoting]
+
+    view = dataview.DataView(FakeVocab(), QuotationStorage(), None, None)
+    referrers = []
+    references = view._get_references_to(item, referrers)
+    assert queried == [['/thing/1', '/alias/1']]
+    assert referrers == ['/record/2']
+    assert references == [{'@id': '/record/2', 'mainEntity': {'@id': '/work/2'}},
+                          {'@id': '/work/2', 'label': 'Work',
+                           'subject': {'@id': '/thing/1'}}]
+
+
+def test_lookup_of_missing_ids(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr('lxltools.cache.time.time', lambda: now[0])
+    fetched = []
+    record = _record(1)
+
+    class MissingStorage:
+        found = False
+
+        def get_record(self, item_id):
+            fetched.append(item_id)
+            return record if self.found else None
+
+    storage = MissingStorage()
+    view = dataview.DataView(FakeVocab(), storage, None, None, missing_ttl=60)
+    assert view.lookup('/thing/1') == dataview._placeholder('/thing/1')
+    now[0] += 59
+    assert view.lookup('/thing/1') == dataview._placeholder('/thing/1')
+    assert fetched == ['/thing/1']
+
+    now[0] += 2
+    assert view.lookup('/thing/1') == dataview._placeholder('/thing/1')
+    assert fetched == ['/thing/1'] * 2
+
+    storage.found = True
+    view.apply_changes([(record, False)])
+    assert view.lookup('/thing/1') == {'@id': '/thing/1'}
+    assert fetched == ['/thing/1'] * 3
@@ -0,0 +1,85 @@
+from __future__ import unicode_literals
+import os
+import shutil
+import tempfile
+from os import path as P
+import pytest
+
+graphcache = pytest.importorskip('lxltools.graphcache')
+from rdflib import Literal, URIRef
+
+
+VOCAB = """
+@prefix : <http://example.org/ns/> .
+@prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#> .
+:Thing rdfs:label "Thing"@en .
+"""
+
+
+def test_persistent_contexts():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        vocab_path = P.join(tmpdir, 'vocab.ttl')
+        with open(vocab_path, 'w') as f:
+            f.write(VOCAB)
+        cachedir = P.join(tmpdir, 'cache')
+
+        cache = graphcache.GraphCache(cachedir, persistent=True)
+        assert len(cache.load(vocab_path)) == 1
+        cache.close()
+
+        cache = graphcache.GraphCache(cachedir, persistent=True)
+        assert vocab_path in cache.mtime_map
+        graph = cache.load(vocab_path)
+        assert graph.identifier == URIRef('file://' + vocab_path)
+        label = graph.value(URIRef('http://example.org/ns/Thing'),
+                            URIRef('http://www.w3.org/2000/01/rdf-schema#label'))
+        assert label == Literal('Thing', lang='en')
+        cache.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_binary_cache_files():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        url = 'http://example.org/ns/'
+        cache_path = P.join(tmpdir, 'http%3A%2F%2Fexample.org%2Fns%2F')
+        with open(cache_path + '.ttl', 'w') as f:
+            f.write(VOCAB)
+
+        graph = graphcache.GraphCache(tmpdir).load(url)
+        assert P.exists(cache_path + '.rdfb')
+        os.remove(cache_path + '.ttl')
+
+        cache = graphcache.GraphCache(tmpdir)
+        reloaded = cache.load(url)
+        assert set(reloaded) == set(graph)
+        assert reloaded.identifier == URIRef(url)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_load_many():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        paths = []
+        for name in ['a', 'b']:
+            path = P.join(tmpdir, name + '.ttl')
+            with open(path, 'w') as f:
+                f.write(VOCAB.replace('Thing', name))
+            paths.append(path)
+
+        cache = graphcache.GraphCache(P.join(tmpdir, 'cache'))
+        graphs = cache.load_many(paths)
+        assert [len(graph) for graph in graphs] == [1, 1]
+        assert len(cache.graph) == 2
+
+        with open(paths[0], 'w') as f:
+            f.write(VOCAB.replace('Thing', 'c'))
+        os.utime(paths[0], (0, cache.mtime_map[paths[0]] + 1))
+        graph = cache.load(paths[0])
+        assert URIRef('http://example.org/ns/c') in graph.subjects()
+        assert len(cache.graph) == 2
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,98 @@
+from __future__ import unicode_literals
+from collections import namedtuple
+from lxltools.lddb.search import EmbeddedSearch
+
+
+Record = namedtuple('Record', 'identifier, data, created, modified')
+
+
+class FakeStorage:
+    def __init__(self, changes):
+        self.changes = changes
+
+    def find_changes(self, since=None, limit=None):
+        if since and not isinstance(since, tuple):
+            since = (since, '')
+        changes = sorted(self.changes, key=lambda change: (change[0].modified,
+                                                           change[0].identifier))
+        return [(rec, deleted) for rec, deleted in changes
+                if not since or (rec.modified, rec.identifier) > since][:limit]
+
+
+def _record(n, modified, **entry):
+    entry.setdefault('@id', 'http://example.org/%s' % n)
+    return Record('/record/%s' % n, {'@graph': [entry]}, modified, modified)
+
+
+def _make_index():
+    return EmbeddedSearch.from_storage(FakeStorage([
+        (_record(1, '2016-01-01', **{'@type': 'Person', 'name': 'Some One'}), False),
+        (_record(2, '2016-01-02', **{'@type': 'Person', 'name': 'Some Body',
+                                     'sameAs': [{'@id': 'http://other.org/2'}]}), False),
+        (_record(3, '2016-01-03', **{'@type': 'Organization', 'name': 'Nobody'}), False),
+    ]))
+
+
+def test_query_string():
+    index = _make_index()
+    results = index.search(body={'query': {'bool': {'must': [
+        {'query_string': {'query': 'some'}}]}}})
+    assert results['hits']['total'] == 2
+    results = index.search(body={'query': {'query_string': {'query': 'nob*'}}})
+    assert [hit['_id'] for hit in results['hits']['hits']] == ['http://example.org/3']
+
+
+def test_match_and_site_filter():
+    index = _make_index()
+    results = index.search(body={'query': {'bool': {
+        'must': [{'query_string': {'query': '*'}}, {'match': {'@type': 'Person'}}],
+        'should': [{'prefix': {'@id': 'http://other.org/'}},
+                   {'prefix': {'sameAs.@id': 'http://other.org/'}}],
+        'minimum_should_match': 1}}})
+    assert [hit['_id'] for hit in results['hits']['hits']] == ['http://example.org/2']
+
+
+def test_aggregations_and_paging():
+    index = _make_index()
+    body = {
+        'query': {'match_all': {}},
+        'aggs': {'@type': {'terms': {'field': '@type', 'size': 1000}, 'aggs': {}}},
+        'sort': [{'_score': 'desc'}, {'@id': 'asc'}],
+        '_source': ['@id']
+    }
+    results = index.search(body=body, size=2, from_=0)
+    buckets = results['aggregations']['@type']['buckets']
+    assert buckets == [{'key': 'Person', 'doc_count': 2},
+                       {'key': 'Organization', 'doc_count': 1}]
+    hits = results['hits']['hits']
+    assert [hit['_source'] for hit in hits] == [
+        {'@id': 'http://example.org/1'}, {'@id': 'http://example.org/2'}]
+    body['search_after'] = hits[-1]['sort']
+    results = index.search(body=body, size=2, from_=0)
+    assert [hit['_id'] for hit in results['hits']['hits']] == ['http://example.org/3']
+
+
+def test_incremental_update():
+    changes = []
+    storage = FakeStorage(changes)
+    index = EmbeddedSearch.from_storage(storage)
+    changes.append((_record(1, '2016-01-01', name='Some One'), False))
+    index.update_from(storage)
+    assert index.search(body={'query': {'match': {'name': 'one'}}})['hits']['total'] == 1
+    changes.append((_record(1, '2016-01-02', name='Other'), False))
+    index.update_from(storage)
+    assert index.search(body={'query': {'match': {'name': 'one'}}})['hits']['total'] == 0
+    for query in [{'query_string': {'query': 'on*'}}, {'prefix': {'name': 'So'}}]:
+        assert index.search(body={'query': query})['hits']['total'] == 0
+    for query in [{'query_string': {'query': 'oth*'}}, {'prefix': {'name': 'Ot'}}]:
+        assert index.search(body={'query': query})['hits']['total'] == 1
+    changes.append((_record(1, '2016-01-03', name='Other'), True))
+    index.update_from(storage)
+    assert not index.docs
+
+
+def test_update_with_equal_modification_times():
+    storage = FakeStorage([(_record(n, '2016-01-01', name='Some %s' % n), False)
+                           for n in range(1500)])
+    index = EmbeddedSearch.from_storage(storage)
+    assert len(index.docs) == 1500
@@ -0,0 +1,56 @@
+from __future__ import unicode_literals
+import threading
+import pytest
+
+storage = pytest.importorskip('lxltools.lddb.storage')
+
+
+class FakeConnection:
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_connection_per_thread():
+    store = storage.Storage(get_connection=FakeConnection)
+    main = store.connection
+    assert store.connection is main
+
+    connections = []
+    thread = threading.Thread(target=lambda: connections.append(store.connection))
+    thread.start()
+    thread.join()
+    assert connections[0] is not main
+
+    store.disconnect()
+    assert main.closed and connections[0].closed
+    assert store.connection is not main
+
+
+def test_release_thread_connection():
+    store = storage.Storage(get_connection=FakeConnection)
+    connections = []
+
+    def use_connection():
+        connections.append(store.connection)
+        store.release_connection()
+
+    threads = [threading.Thread(target=use_connection) for i in range(5)]
+    for thread in threads:
+        thread.start()
+        thread.join()
+    assert all(connection.closed for connection in connections)
+    assert store._connections == []
+
+
+def test_find_by_quotation_of_aliases(monkeypatch):
+    store = storage.Storage(get_connection=FakeConnection)
+    monkeypatch.setattr(store, '_do_find',
+                        lambda where, keys, limit, offset, stream: (where, keys))
+    where, keys = store.find_by_quotation(['/a', '/b'], limit=10)
+    assert where.count(' OR ') == 3
+    assert sorted(keys.values()) == [
+        '[{"@graph": {"@id": "/a"}}]', '[{"@graph": {"@id": "/b"}}]',
+        '[{"@graph": {"sameAs": [{"@id": "/a"}]}}]',
+        '[{"@graph": {"sameAs": [{"@id": "/b"}]}}]']
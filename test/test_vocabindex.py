@@ -0,0 +1,57 @@
+from __future__ import unicode_literals
+import shutil
+import tempfile
+from os import path as P
+from lxltools.vocabindex import VocabIndex
+
+
+def _make_vocab():
+    index = {
+        'Person': {'@id': 'http://example.org/ns/Person', 'label': 'Person',
+                   'curie': 'Person', 'properties': ['name']},
+        'name': {'@id': 'http://example.org/ns/name', 'label': 'name',
+                 'curie': 'name'},
+        'label': {'@id': 'http://example.org/ns/label', 'label': 'label',
+                  'curie': 'label'},
+        'r\xe4tt': {'@id': 'http://example.org/ns/r\xe4tt', 'label': None,
+                    'curie': 'r\xe4tt', '@type': '@id'},
+    }
+    return VocabIndex(index, ['r\xe4tt'], ['name', 'label'])
+
+
+def test_snapshots():
+    vocab = _make_vocab()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for save, load, fname in [(vocab.save, VocabIndex.load, 'vocab.json'),
+                (vocab.save_mapped, VocabIndex.load_mapped, 'vocab.vix')]:
+            fpath = P.join(tmpdir, fname)
+            save(fpath)
+            loaded = load(fpath)
+            assert dict(loaded.index) == vocab.index
+            assert loaded.label_keys == vocab.label_keys
+            assert loaded.unstable_keys == vocab.unstable_keys
+            item = {'@type': 'Person', 'label': 'x', 'name': 'y', 'r\xe4tt': 'z'}
+            assert loaded.sortedkeys(dict(item)) == vocab.sortedkeys(dict(item))
+            assert loaded.get_label_for(item) == 'y'
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_mapped_lookups():
+    vocab = _make_vocab()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fpath = P.join(tmpdir, 'vocab.vix')
+        vocab.save_mapped(fpath)
+        index = VocabIndex.load_mapped(fpath).index
+        assert 'name' in index
+        assert 'missing' not in index
+        assert index.get('missing') is None
+        assert index['r\xe4tt']['@type'] == '@id'
+        assert index.by_iri('http://example.org/ns/Person')['curie'] == 'Person'
+        assert index.by_iri('http://example.org/ns/Other') is None
+        assert sorted(index) == sorted(vocab.index)
+        index.close()
+    finally:
+        shutil.rmtree(tmpdir)